@@ -3,7 +3,21 @@
 # Written by: Vincenzo Maffione <v DOT maffione AT gmail DOT com>
 
 import re
+import csv
+import array
 import os
+import sys
+import json
+import fcntl
+import hashlib
+import shlex
+import signal
+import stat
+import time
+import itertools
+import socket
+import struct
+import threading
 import argparse
 import subprocess
 
@@ -43,80 +57,3350 @@ def get_backend_name(args, i):
     return args.backend_type[i]
 
 
-def sysfs_write(filename, s):
-    print("echo \"%s\" > %s" % (s, filename))
-    sysf = open(filename, 'w')
-    sysf.write(s)
-    sysf.close()
+# Minimal client for the QEMU Machine Protocol (QMP)
+class QMPError(Exception):
+    pass
 
 
-# Get the name of the current driver bound to @pcidev
-def pci_driver_name(args, pcidev):
+class QMP:
+    # QEMU serves one client at a time on a QMP socket, and the others
+    # are left waiting in the listen backlog: replies are only awaited
+    # for @reply_timeout seconds, so that a busy socket is an error
+    # rather than a hang
+    def __init__(self, path, timeout = 10, greeting = True,
+                 reply_timeout = 30):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.sock.connect(path)
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise QMPError("Cannot connect to QMP socket %s" % path)
+                time.sleep(0.05)
+        self.sock.settimeout(reply_timeout)
+        self.rfile = self.sock.makefile('r')
+        if greeting:
+            try:
+                self.greeting = self.recv()
+            except QMPError:
+                self.close()
+                raise QMPError("No greeting on QMP socket %s (is another "
+                               "client connected?)" % path)
+            self.command('qmp_capabilities')
+
+    def recv(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            raise QMPError("QMP reply timed out")
+        if not line:
+            raise QMPError("QMP connection closed")
+        return json.loads(line)
+
+    def command(self, name, arguments = None):
+        req = {'execute': name}
+        if arguments:
+            req['arguments'] = arguments
+        self.sock.sendall((json.dumps(req) + '\n').encode('ascii'))
+        while True:
+            resp = self.recv()
+            if 'return' in resp:
+                return resp['return']
+            if 'error' in resp:
+                raise QMPError("%s: %s" % (name, resp['error']['desc']))
+            # Asynchronous event, skip it
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+# Parse a Linux CPU list (e.g. "0-3,8,10-11") into a list of integers
+def parse_cpu_list(s):
+    cpus = []
+    for chunk in s.strip().split(','):
+        if not chunk:
+            continue
+        if '-' in chunk:
+            lo, hi = chunk.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(chunk))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    return ','.join(['%d' % c for c in cpus])
+
+
+# NUMA node of host PCI device @pcidev, or -1 if unknown
+def pci_numa_node(pcidev):
+    try:
+        return int(open("/sys/bus/pci/devices/%s/numa_node"
+                        % pcidev).read().strip())
+    except:
+        return -1
+
+
+# List of host CPUs belonging to NUMA node @node (all the online
+# CPUs if @node is negative)
+def numa_node_cpus(node):
+    if node < 0:
+        path = "/sys/devices/system/cpu/online"
+    else:
+        path = "/sys/devices/system/node/node%d/cpulist" % node
+    return parse_cpu_list(open(path).read())
+
+
+# Decide which host cores will run the vCPU threads and which ones will
+# run QEMU I/O threads and vhost workers. Returns a (vcpu_cpus, emu_cpus)
+# tuple.
+def pin_plan(args):
+    if args.pin_cpus:
+        cpus = parse_cpu_list(args.pin_cpus)
+        if len(cpus) < args.num_cpus:
+            print("--pin-cpus must list at least %d cores" % args.num_cpus)
+            quit(1)
+    else:
+        node = -1
+        for pcidev in args.pci_passthrough:
+            node = pci_numa_node(pcidev)
+            if node >= 0:
+                break
+        cpus = numa_node_cpus(node)
+        # Leave core 0 to the host, if we can afford it
+        if cpus[0] == 0 and len(cpus) > args.num_cpus + 1:
+            cpus = cpus[1:]
+        if len(cpus) < args.num_cpus:
+            print("Not enough host cores on NUMA node %d to pin %d vCPUs"
+                  % (node, args.num_cpus))
+            quit(1)
+        cpus = cpus[:args.num_cpus + 1]
+
+    vcpu_cpus = cpus[:args.num_cpus]
+    emu_cpus = cpus[args.num_cpus:]
+    if len(emu_cpus) == 0:
+        emu_cpus = cpus
+
+    return vcpu_cpus, emu_cpus
+
+
+# NUMA node of host CPU @cpu (0 if the host is not NUMA)
+def cpu_numa_node(cpu):
+    try:
+        for entry in os.listdir('/sys/devices/system/cpu/cpu%d' % cpu):
+            m = re.match(r'^node(\d+)$', entry)
+            if m:
+                return int(m.group(1))
+    except OSError:
+        pass
+    return 0
+
+
+# Set the CPU affinity of thread @tid, using sudo if we are not allowed
+# to do it directly (e.g. vhost kernel threads)
+def pin_thread(tid, cpus):
+    try:
+        os.sched_setaffinity(tid, cpus)
+    except OSError:
+        cmdexe('sudo taskset -pc %s %d' % (format_cpu_list(cpus), tid),
+               False)
+
+
+# Threads of vhost workers serving the QEMU process @pid. Depending on
+# the kernel version, they are either tasks of the QEMU process or
+# kernel threads called "vhost-<pid>".
+def vhost_threads(pid):
+    comm = 'vhost-%d' % pid
+    tids = []
+    for d in ['/proc/%d/task' % pid, '/proc']:
+        for entry in os.listdir(d):
+            if not entry.isdigit():
+                continue
+            try:
+                if open('%s/%s/comm' % (d, entry)).read().strip() == comm:
+                    tids.append(int(entry))
+            except IOError:
+                pass
+    return tids
+
+
+# Pin the threads of the running QEMU process @pid, using QMP to find
+# the vCPU threads
+def pin_vm_threads(args, pid, vcpu_cpus, emu_cpus):
+    qmp = QMP(args.qmp_socket)
+    vcpus = qmp.command('query-cpus-fast')
+    iothreads = qmp.command('query-iothreads')
+    qmp.close()
+
+    for vcpu in vcpus:
+        cpu = vcpu_cpus[vcpu['cpu-index'] % len(vcpu_cpus)]
+        pin_thread(vcpu['thread-id'], [cpu])
+        print("vCPU %d (tid %d) pinned to core %d" % (vcpu['cpu-index'],
+                                                     vcpu['thread-id'], cpu))
+
+    emu_tids = [pid] + [iot['thread-id'] for iot in iothreads]
+    if args.vhost_net:
+        emu_tids += vhost_threads(pid)
+    for tid in emu_tids:
+        pin_thread(tid, emu_cpus)
+    print("I/O and vhost threads %s pinned to cores %s" %
+          (emu_tids, format_cpu_list(emu_cpus)))
+
+
+# Convert a QEMU size string (e.g. 512M, 2G) into bytes. Sizes without
+# suffix are in MiB, like for the -m option.
+def parse_size(s):
+    m = re.match(r'^(\d+)([KMGT]?)B?$', s.strip().upper())
+    if m is None:
+        print("Invalid size '%s'" % s)
+        quit(1)
+    unit = m.group(2) or 'M'
+    return int(m.group(1)) * 1024 ** ('KMGT'.index(unit) + 1)
+
+
+# Mount point of a hugetlbfs filesystem using @pagesize_kb pages
+def hugetlbfs_mount(pagesize_kb):
+    default_kb = None
+    for line in open('/proc/meminfo'):
+        if line.startswith('Hugepagesize:'):
+            default_kb = int(line.split()[1])
+
+    for line in open('/proc/mounts'):
+        fields = line.split()
+        if len(fields) < 4 or fields[2] != 'hugetlbfs':
+            continue
+        mount_kb = default_kb
+        for opt in fields[3].split(','):
+            if opt.startswith('pagesize='):
+                mount_kb = parse_size(opt[len('pagesize='):]) // 1024
+        if mount_kb == pagesize_kb:
+            return fields[1]
+
+    return None
+
+
+# Number of free hugepages of size @pagesize_kb, on the whole host or
+# on NUMA node @node
+def hugepages_free(pagesize_kb, node = None):
+    if node is None:
+        path = '/sys/kernel/mm/hugepages'
+    else:
+        path = '/sys/devices/system/node/node%d/hugepages' % node
+    try:
+        return int(open('%s/hugepages-%dkB/free_hugepages' %
+                        (path, pagesize_kb)).read().strip())
+    except IOError:
+        return 0
+
+
+# Build the memory backend objects (and the guest NUMA layout) for the
+# guest RAM. Hugepages are used with --hugepages, or when a vhost-user
+# backend needs guest memory to be shared.
+def memory_backend_args(args, num_backends, vcpu_cpus):
+    share = 'vhost-user' in args.backend_type[:num_backends]
+
+    if args.hugepages is None:
+        if not share:
+            return []
+        # Legacy vhost-user configuration
+        return ['-numa', 'node,memdev=mem0',
+                '-object', 'memory-backend-file,id=mem0,size=%s,'
+                'mem-path=/dev/hugepages,share=on' % args.memory]
+
+    pagesize_kb = {'2M': 2048, '1G': 1024 * 1024}[args.hugepages]
+
+    mem_path = args.hugepages_path
+    if mem_path is None:
+        mem_path = hugetlbfs_mount(pagesize_kb)
+        if mem_path is None:
+            print("No hugetlbfs mounted with %s pages" % args.hugepages)
+            quit(1)
+
+    # Each entry is (vCPU indexes, host nodes, size in MiB)
+    mem_mib = parse_size(args.memory) // (1024 * 1024)
+    layout = []
+    if args.guest_numa:
+        if vcpu_cpus is None:
+            print("--guest-numa requires --pin")
+            quit(1)
+        nodes = []
+        for cpu in vcpu_cpus:
+            if cpu_numa_node(cpu) not in nodes:
+                nodes.append(cpu_numa_node(cpu))
+        left = mem_mib
+        for node in nodes:
+            vcpus = [i for i in range(args.num_cpus)
+                        if cpu_numa_node(vcpu_cpus[i]) == node]
+            if node == nodes[-1]:
+                size = left
+            else:
+                size = mem_mib * len(vcpus) // args.num_cpus
+            left -= size
+            layout.append((vcpus, [node], size))
+    else:
+        if args.host_nodes is not None:
+            nodes = parse_cpu_list(args.host_nodes)
+        elif vcpu_cpus is not None:
+            nodes = sorted(set([cpu_numa_node(cpu) for cpu in vcpu_cpus]))
+        else:
+            nodes = []
+        layout.append((None, nodes, mem_mib))
+
+    argv = []
+    for k in range(len(layout)):
+        vcpus, nodes, size = layout[k]
+
+        pages = (size * 1024 + pagesize_kb - 1) // pagesize_kb
+        if len(nodes) == 1:
+            free = hugepages_free(pagesize_kb, nodes[0])
+            where = 'on host node %d' % nodes[0]
+        else:
+            free = hugepages_free(pagesize_kb)
+            where = 'on the host'
+        if free < pages:
+            print("Not enough free %s hugepages %s (%d needed, %d free)" %
+                  (args.hugepages, where, pages, free))
+            quit(1)
+
+        argv += ['-object', 'memory-backend-file,id=mem%d,size=%dM,'
+                 'mem-path=%s,share=%s,prealloc=%s' %
+                 (k, size, mem_path, 'on' if share else 'off',
+                  'on' if args.prealloc else 'off')]
+        if len(nodes) > 0:
+            for node in nodes:
+                argv[-1] += ',host-nodes=%d' % node
+            argv[-1] += ',policy=bind'
+
+        argv += ['-numa', 'node,nodeid=%d,memdev=mem%d' % (k, k)]
+        if vcpus is not None:
+            for vcpu in vcpus:
+                argv[-1] += ',cpus=%d' % vcpu
+
+    return argv
+
+
+# Write a list of (filename, string) pairs to sysfs/procfs. Writes that
+# need privileges are all done by a single sudo invocation.
+def sysfs_write_many(writes):
+    script = ''
+    for filename, s in writes:
+        try:
+            sysf = open(filename, 'w')
+            sysf.write(s)
+            sysf.close()
+        except (IOError, OSError):
+            script += 'echo %s > %s; ' % (shlex.quote(s),
+                                          shlex.quote(filename))
+    if script:
+        subprocess.check_call(['sudo', 'sh', '-c', script])
+
+
+# Hexadecimal CPU mask for the list of CPUs @cpus, in the format used
+# by rps_cpus, xps_cpus and smp_affinity
+def cpu_mask(cpus):
+    mask = 0
+    for cpu in cpus:
+        mask |= 1 << cpu
+    words = []
+    while True:
+        words.insert(0, '%08x' % (mask & 0xffffffff))
+        mask >>= 32
+        if mask == 0:
+            break
+    return ','.join(words)
+
+
+# Host IRQs of the MSI-X vectors of a device passed through with VFIO
+def vfio_msix_irqs(pcidev):
+    irqs = []
+    for line in open('/proc/interrupts'):
+        if 'vfio-msix' in line and pcidev in line:
+            irqs.append(int(line.split(':')[0]))
+    return irqs
+
+
+# Align each queue pair of the data interfaces with a pinned vCPU: queue
+# j is served on the host by the core running vCPU (j % num_cpus). This
+# covers TAP XPS/RPS masks, vhost workers and the MSI-X IRQs of devices
+# passed through with VFIO.
+def queue_affinity(args, pid, num_backends, vcpu_cpus):
+    writes = []
+    vhost_tids = sorted(vhost_threads(pid)) if args.vhost_net else []
+    vhost_next = 0
+
+    for i in range(num_backends):
+        if args.backend_type[i] != 'tap':
+            continue
+
+        backend_ifname = get_backend_ifname(args, i)
+        for j in range(args.queues[i]):
+            cpu = vcpu_cpus[j % len(vcpu_cpus)]
+            writes.append(('/sys/class/net/%s/queues/tx-%d/xps_cpus'
+                           % (backend_ifname, j), cpu_mask([cpu])))
+            writes.append(('/sys/class/net/%s/queues/rx-%d/rps_cpus'
+                           % (backend_ifname, j), cpu_mask([cpu])))
+            # One vhost worker per queue pair, created in queue order
+            if args.frontend_type[i] == 'virtio-net-pci' and \
+                    vhost_next < len(vhost_tids):
+                pin_thread(vhost_tids[vhost_next], [cpu])
+                vhost_next += 1
+
+        print("Queues of %s aligned to cores %s" % (backend_ifname,
+              format_cpu_list(vcpu_cpus[:args.queues[i]])))
+
+    for pcidev in args.pci_passthrough:
+        irqs = vfio_msix_irqs(pcidev)
+        for j in range(len(irqs)):
+            cpu = vcpu_cpus[j % len(vcpu_cpus)]
+            writes.append(('/proc/irq/%d/smp_affinity_list' % irqs[j],
+                           '%d' % cpu))
+
+    sysfs_write_many(writes)
+
+
+# Use the QEMU guest agent to enable all the queues of the multiqueue
+# virtio-net interfaces inside the guest (ethtool -L <if> combined N).
+# The guest interfaces are found by MAC address.
+def guest_set_channels(args, num_backends, timeout = 300):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            qga = QMP(args.guest_agent_socket, greeting = False)
+        except QMPError:
+            qga = None
+        try:
+            if qga is None:
+                raise QMPError("Guest agent socket not available")
+            qga.command('guest-ping')
+            interfaces = qga.command('guest-network-get-interfaces')
+            break
+        except (QMPError, IOError, ValueError):
+            if qga is not None:
+                qga.close()
+            if time.time() > deadline:
+                print("Guest agent not reachable, queues not configured")
+                return
+            time.sleep(2)
+
+    for i in range(num_backends):
+        if args.frontend_type[i] != 'virtio-net-pci' or args.queues[i] < 2:
+            continue
+        mac = '00:aa:bb:cc:%02x:%02x' % (args.mgmt_idx, args.idx[i])
+        for intf in interfaces:
+            if intf.get('hardware-address', '').lower() != mac:
+                continue
+            res = qga.command('guest-exec', {'path': 'ethtool',
+                              'arg': ['-L', intf['name'], 'combined',
+                                      '%d' % args.queues[i]]})
+            print("Guest interface %s: ethtool -L combined %d (guest pid %d)"
+                  % (intf['name'], args.queues[i], res['pid']))
+
+    qga.close()
+
+
+# Normalize a PCI address in the form [dddd:]bb:dd.f into the full
+# dddd:bb:dd.f form used by sysfs. Returns None if the address is not
+# valid.
+def pci_normalize(pcidev):
+    m = re.match(r'^(?:([0-9a-fA-F]{4}):)?([0-9a-fA-F]{2}:[0-9a-fA-F]{2}'
+                 r'\.[0-7])$', pcidev)
+    if m is None:
+        return None
+    return ('%s:%s' % (m.group(1) or '0000', m.group(2))).lower()
+
+
+def pci_sysfs(pcidev):
+    return '/sys/bus/pci/devices/%s' % pcidev
+
+
+# Vendor and device IDs of host PCI device @pcidev, read from sysfs
+def pci_ids(pcidev):
+    try:
+        vendor = open(pci_sysfs(pcidev) + '/vendor').read().strip()
+        devid = open(pci_sysfs(pcidev) + '/device').read().strip()
+    except IOError:
+        print("Cannot find PCI device %s on the PCI subsystem" % pcidev)
+        quit(1)
+    return vendor[2:], devid[2:]
+
+
+# Name of the driver currently bound to @pcidev (None if unbound)
+def pci_driver_name(pcidev):
+    link = pci_sysfs(pcidev) + '/driver'
+    if not os.path.islink(link):
+        return None
+    return os.path.basename(os.readlink(link))
+
+
+# IOMMU group of @pcidev, and the full addresses of all the devices
+# in that group
+def pci_iommu_group(pcidev):
+    link = pci_sysfs(pcidev) + '/iommu_group'
+    if not os.path.islink(link):
+        return None, []
+    group = os.path.basename(os.readlink(link))
+    return group, sorted(os.listdir('/sys/kernel/iommu_groups/%s/devices'
+                                    % group))
+
+
+# With VFIO, a whole IOMMU group is assigned to the VM: check that
+# every other device in the groups of @pcidevs is passed through too,
+# or is a bridge, unbound or already bound to vfio-pci
+def pci_check_iommu_groups(pcidevs):
+    groups = {}
+    for pcidev in pcidevs:
+        group, members = pci_iommu_group(pcidev)
+        if group is None:
+            print("PCI device %s is not in any IOMMU group (is the IOMMU "
+                  "enabled?)" % pcidev)
+            quit(1)
+        groups[group] = members
+
+    for group in sorted(groups):
+        for member in groups[group]:
+            if member in pcidevs:
+                continue
+            pciclass = open('/sys/bus/pci/devices/%s/class'
+                            % member).read().strip()
+            if pciclass.startswith('0x0604'):
+                continue
+            driver = pci_driver_name(member)
+            if driver in [None, 'vfio-pci', 'pci-stub']:
+                continue
+            print("IOMMU group %s also contains %s (bound to %s): pass it "
+                  "through too, or bind it to vfio-pci" %
+                  (group, member, driver))
+            quit(1)
+
+    return groups
+
+
+# Load the kernel modules needed by the passthrough driver, with a
+# single modprobe for all the missing ones
+def pci_load_modules(driver):
+    if driver == 'pci-stub':
+        modules = ['pci_stub']
+    else:
+        modules = ['vfio', 'vfio_pci', 'vfio_iommu_type1']
+    missing = [m for m in modules if not os.path.isdir('/sys/module/%s' % m)]
+    if missing:
+        cmdexe('sudo modprobe -a %s' % ' '.join(missing))
+
+
+# Bind @pcidev to @driver using driver_override, so that no other
+# device with the same vendor/device IDs is affected
+def pci_bind(pcidev, driver):
+    writes = [(pci_sysfs(pcidev) + '/driver_override', driver)]
+    if pci_driver_name(pcidev) is not None:
+        writes.append((pci_sysfs(pcidev) + '/driver/unbind', pcidev))
+    writes.append(('/sys/bus/pci/drivers_probe', pcidev))
+    sysfs_write_many(writes)
+
+
+# Give @pcidev back to its original @driver (None if it was unbound)
+def pci_unbind_restore(pcidev, driver):
+    # A newline clears driver_override
+    writes = [(pci_sysfs(pcidev) + '/driver_override', '\n')]
+    if pci_driver_name(pcidev) is not None:
+        writes.append((pci_sysfs(pcidev) + '/driver/unbind', pcidev))
+    if driver is not None:
+        writes.append(('/sys/bus/pci/drivers_probe', pcidev))
+    sysfs_write_many(writes)
+
+    if driver is not None and pci_driver_name(pcidev) != driver and \
+            os.path.isdir('/sys/bus/pci/drivers/%s' % driver):
+        sysfs_write_many([('/sys/bus/pci/drivers/%s/bind' % driver, pcidev)])
+
+
+# Run @func(pcidev, driver) for all the (pcidev, driver) pairs in
+# parallel. Returns the list of pcidevs that failed.
+def pci_parallel(func, pairs):
+    failed = []
+
+    def worker(pcidev, driver):
+        try:
+            func(pcidev, driver)
+        except (IOError, OSError, subprocess.CalledProcessError) as e:
+            print("PCI device %s: %s" % (pcidev, e))
+            failed.append(pcidev)
+
+    threads = [threading.Thread(target = worker, args = pair)
+               for pair in pairs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
+
+
+# The restore records remember the original driver of each device
+# passed through, so that it can be restored even if qrun crashed. They
+# are updated under pci_records_lock(), as concurrent launches share them.
+def pci_records_path(run_dir):
+    return os.path.join(run_dir, 'pci-restore.json')
+
+
+def pci_records_lock(run_dir):
+    return FileLock(pci_records_path(run_dir) + '.lock')
+
+
+def pci_records_load(run_dir):
+    return json_table_load(pci_records_path(run_dir))
+
+
+def pci_records_store(run_dir, records):
+    json_table_store(pci_records_path(run_dir), records)
+
+
+def pid_alive(pid):
+    return os.path.exists('/proc/%d' % pid)
+
+
+# Restore the original drivers of the devices recorded by qrun
+# processes that are not alive anymore
+def pci_restore_stale(run_dir):
+    with pci_records_lock(run_dir):
+        records = pci_records_load(run_dir)
+        stale = [pcidev for pcidev in records
+                 if not pid_alive(records[pcidev]['owner'])]
+        if not stale:
+            return
+        print("Restoring PCI devices left by dead qrun processes: %s" %
+              ' '.join(stale))
+        failed = pci_parallel(pci_unbind_restore,
+                              [(pcidev, records[pcidev]['driver'])
+                               for pcidev in stale])
+        for pcidev in stale:
+            if pcidev not in failed:
+                del records[pcidev]
+        pci_records_store(run_dir, records)
+
+
+# Bind all the @pcidevs to the passthrough driver, recording their
+# original drivers first
+def pci_passthrough_setup(args, pcidevs):
+    pci_restore_stale(args.run_dir)
+
+    with pci_records_lock(args.run_dir):
+        records = pci_records_load(args.run_dir)
+        for pcidev in pcidevs:
+            if pcidev in records:
+                print("PCI device %s is already passed through by qrun "
+                      "process %d" % (pcidev, records[pcidev]['owner']))
+                quit(1)
+            driver = pci_driver_name(pcidev)
+            if driver in ['vfio-pci', 'pci-stub']:
+                driver = None
+            records[pcidev] = {'driver': driver, 'owner': os.getpid()}
+        pci_records_store(args.run_dir, records)
+
+    pci_load_modules(args.pci_passthrough_driver)
+    failed = pci_parallel(pci_bind, [(pcidev, args.pci_passthrough_driver)
+                                     for pcidev in pcidevs])
+    if failed:
+        print("Failed to bind %s to %s" % (' '.join(failed),
+                                           args.pci_passthrough_driver))
+        pci_passthrough_restore(args, pcidevs)
+        quit(1)
+
+    for pcidev in pcidevs:
+        print("PCI device %s (%s:%s) bound to %s" % ((pcidev,) +
+              pci_ids(pcidev) + (args.pci_passthrough_driver,)))
+
+
+# Give back @pcidevs to their original drivers
+def pci_passthrough_restore(args, pcidevs):
+    with pci_records_lock(args.run_dir):
+        records = pci_records_load(args.run_dir)
+    pairs = [(pcidev, records[pcidev]['driver']) for pcidev in pcidevs
+             if pcidev in records]
+    failed = pci_parallel(pci_unbind_restore, pairs)
+    with pci_records_lock(args.run_dir):
+        records = pci_records_load(args.run_dir)
+        for pcidev, driver in pairs:
+            if pcidev not in failed:
+                records.pop(pcidev, None)
+        pci_records_store(args.run_dir, records)
+
+
+# Exclusive lock on @path, held for the duration of a with block. Used
+# to serialize the updates of the tables shared by concurrent qrun
+# processes.
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+# Token identifying a launch in the index and VF tables. A qrun process
+# runs a single launch but qrund runs many, so the process ID alone does
+# not do; it is still part of the token, to reclaim the entries of dead
+# processes.
+def launch_token():
+    return '%d:%s' % (os.getpid(), os.urandom(4).hex())
+
+
+def launch_token_alive(token):
+    return pid_alive(int(('%s' % token).split(':')[0]))
+
+
+def json_table_load(path):
+    try:
+        return json.load(open(path))
+    except (IOError, ValueError):
+        return {}
+
+
+def json_table_store(path, table):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(table, f, indent = 2)
+    os.rename(path + '.tmp', path)
+
+
+# Resolve an SR-IOV physical function, given either as a PCI address or
+# as a network interface name
+def sriov_pf_address(pf):
+    addr = pci_normalize(pf)
+    if addr is None:
+        link = '/sys/class/net/%s/device' % pf
+        if not os.path.islink(link):
+            print("Invalid SR-IOV PF '%s'" % pf)
+            quit(1)
+        addr = os.path.basename(os.readlink(link))
+    if not os.path.exists(pci_sysfs(addr) + '/sriov_totalvfs'):
+        print("PCI device %s does not support SR-IOV" % addr)
+        quit(1)
+    return addr
+
+
+# Virtual functions of PF @pf, as a list of (vf number, VF address)
+def sriov_vfs(pf):
+    vfs = []
+    for entry in os.listdir(pci_sysfs(pf)):
+        m = re.match(r'^virtfn(\d+)$', entry)
+        if m:
+            addr = os.path.basename(os.readlink(os.path.join(pci_sysfs(pf),
+                                                             entry)))
+            vfs.append((int(m.group(1)), addr))
+    return sorted(vfs)
+
+
+# Create all the VFs supported by @pf, if it has none
+def sriov_create_vfs(pf):
+    numvfs = int(open(pci_sysfs(pf) + '/sriov_numvfs').read())
+    if numvfs > 0:
+        return
+    total = open(pci_sysfs(pf) + '/sriov_totalvfs').read().strip()
+    print("Creating %s VFs on PF %s" % (total, pf))
+    sysfs_write_many([(pci_sysfs(pf) + '/sriov_numvfs', total)])
+
+
+# Allocate --sriov-vfs VFs from the --sriov-pf PFs (those on the NUMA
+# node of the --pin cores first), set their MAC/VLAN through the PF and
+# record them in the allocation table. Returns the VF addresses.
+def sriov_allocate(args, reserve = True):
+    pfs = [sriov_pf_address(pf) for pf in args.sriov_pf]
+    if args.pin and args.pin_cpus:
+        node = cpu_numa_node(parse_cpu_list(args.pin_cpus)[0])
+        pfs.sort(key = lambda pf: pci_numa_node(pf) != node)
+
+    table_path = os.path.join(args.run_dir, 'sriov.json')
+    with FileLock(table_path + '.lock'):
+        table = json_table_load(table_path)
+        for vf in list(table):
+            if not launch_token_alive(table[vf]['owner']):
+                del table[vf]
+
+        chosen = []
+        for pf in pfs:
+            # Don't create VFs on the PFs that are not needed
+            if len(chosen) == args.sriov_vfs:
+                break
+            if reserve:
+                sriov_create_vfs(pf)
+            for vfnum, vf in sriov_vfs(pf):
+                if len(chosen) == args.sriov_vfs:
+                    break
+                if vf in table or vf in args.pci_passthrough:
+                    continue
+                chosen.append((pf, vfnum, vf))
+
+        if len(chosen) < args.sriov_vfs:
+            print("Only %d free VFs on PFs %s, %d requested" %
+                  (len(chosen), ' '.join(pfs), args.sriov_vfs))
+            quit(1)
+
+        if not reserve:
+            return [vf for pf, vfnum, vf in chosen]
+
+        cmds = []
+        for k in range(len(chosen)):
+            pf, vfnum, vf = chosen[k]
+            mac = '00:aa:bb:cc:%02x:%02x' % (args.mgmt_idx, 0x80 + k)
+            pf_ifname = os.listdir(pci_sysfs(pf) + '/net')[0]
+            cmd = 'link set %s vf %d mac %s' % (pf_ifname, vfnum, mac)
+            if args.sriov_vlan is not None:
+                cmd += ' vlan %d' % args.sriov_vlan
+            cmds.append(cmd)
+            table[vf] = {'pf': pf, 'vf': vfnum, 'mac': mac,
+                         'owner': args.launch_token}
+        ip_batch(cmds)
+        json_table_store(table_path, table)
+
+    for pf, vfnum, vf in chosen:
+        print("VF %s (PF %s vf %d) allocated as %s" % (vf, pf, vfnum,
+                                                      table[vf]['mac']))
+    return [vf for pf, vfnum, vf in chosen]
+
+
+# Give back the VFs allocated by the launch of @args
+def sriov_release(args):
+    table_path = os.path.join(args.run_dir, 'sriov.json')
+    with FileLock(table_path + '.lock'):
+        table = json_table_load(table_path)
+        for vf in list(table):
+            if table[vf]['owner'] == args.launch_token:
+                del table[vf]
+        json_table_store(table_path, table)
+
+
+# True if nobody is listening on TCP port @port of the host
+def tcp_port_free(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+# Atomically reserve a management index and a block of @num_backends
+# data indexes that are not used by other qrun processes, and whose
+# derived resources (SSH/console/socket ports, TAP names) are free.
+# Returns (mgmt_idx, idx_list).
+def idx_allocate(args, num_backends, reserve = True):
+    table_path = os.path.join(args.run_dir, 'registry.json')
+    with FileLock(table_path + '.lock'):
+        table = json_table_load(table_path)
+        for key in list(table):
+            if not launch_token_alive(table[key]['owner']):
+                del table[key]
+
+        used_mgmt = set([table[key]['mgmt_idx'] for key in table])
+        used_idx = set()
+        for key in table:
+            used_idx.update(table[key]['idx'])
+
+        # Indexes end up in MAC addresses, so they must fit a byte
+        mgmt_idx = None
+        for m in range(1, 255):
+            if m in used_mgmt:
+                continue
+            if args.mgmtnet and \
+                    not tcp_port_free(args.ssh_base_port + m):
+                continue
+            if args.console_tcp and \
+                    not tcp_port_free(args.console_base_port + m):
+                continue
+            mgmt_idx = m
+            break
+
+        idx_list = None
+        for start in range(1, 256 - num_backends):
+            block = range(start, start + num_backends)
+            if any([idx in used_idx for idx in block]):
+                continue
+            busy = False
+            for i in range(num_backends):
+                ifname = '%s%d_%d' % (args.backend_type[i], args.br_idx[i],
+                                      block[i])
+                if args.backend_type[i] == 'tap' and \
+                        os.path.exists('/sys/class/net/%s' % ifname):
+                    busy = True
+                if args.backend_type[i] in ['socket-listen',
+                                            'socket-connect'] and \
+                        not tcp_port_free(4000 + block[i]):
+                    busy = True
+            if not busy:
+                idx_list = list(block)
+                break
+
+        if mgmt_idx is None or idx_list is None:
+            print("No free VM indexes left in %s" % table_path)
+            quit(1)
+
+        if reserve:
+            table[args.launch_token] = {'mgmt_idx': mgmt_idx,
+                                        'idx': idx_list,
+                                        'owner': args.launch_token}
+            json_table_store(table_path, table)
+
+    return mgmt_idx, idx_list
+
+
+def idx_release(args):
+    table_path = os.path.join(args.run_dir, 'registry.json')
+    with FileLock(table_path + '.lock'):
+        table = json_table_load(table_path)
+        table.pop(args.launch_token, None)
+        json_table_store(table_path, table)
+
+
+# Validate the append parameters and complete the append lists, so that
+# they all have an entry for each backend. Returns the number of backends.
+def complete_append_lists(argparser, args):
+    # Don't modify the argparse defaults, they may be used again
+    for name in ['idx', 'br_idx', 'backend_type', 'frontend_type', 'netmap',
+                 'queues']:
+        setattr(args, name, list(getattr(args, name)))
+
+    # Validate append parameters
+    for i in range(len(args.idx)):
+        try:
+            idx = int(args.idx[i])
+            args.idx[i] = idx
+        except ValueError:
+            argparser.error('argument --idx: invalid int value %s' % idx)
+
+    for i in range(len(args.br_idx)):
+        try:
+            idx = int(args.br_idx[i])
+            args.br_idx[i] = idx
+        except ValueError:
+            argparser.error('argument --br-idx: invalid int value %s' % idx)
+
+    # Complete append lists
+    num_backends = max(len(args.idx), len(args.br_idx), len(args.backend_type),
+                       len(args.frontend_type))
+
+    if num_backends > 0 and len(args.idx) == 0:
+        args.idx.append(args.mgmt_idx)
+    while len(args.idx) < num_backends:
+        args.idx.append(args.idx[-1] + 1)
+
+    if num_backends > 0 and len(args.br_idx) == 0:
+        args.br_idx.append(1)
+    while len(args.br_idx) < num_backends:
+        args.br_idx.append(args.br_idx[-1])
+
+    while len(args.backend_type) < num_backends:
+        args.backend_type.append('tap')
+
+    while len(args.frontend_type) < num_backends:
+        args.frontend_type.append('e1000')
+
+    while len(args.netmap) < num_backends:
+        args.netmap.append('vale')
+
+    while len(args.queues) < num_backends:
+        args.queues.append(args.num_queues)
+
+    return num_backends
+
+
+# Run a list of iproute2 commands (without the leading "ip") through a
+# single "ip -batch" invocation, rather than forking once per command.
+# With @force, errors don't stop the batch.
+def ip_batch(cmds, force = False):
+    if len(cmds) == 0:
+        return
+    argv = ['sudo', 'ip'] + (['-force'] if force else []) + ['-batch', '-']
+    proc = subprocess.Popen(argv, stdin=subprocess.PIPE)
+    proc.communicate(('\n'.join(cmds) + '\n').encode('ascii'))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ' '.join(argv))
+
+
+def bridge_setup_cmds(br_idx):
+    return ['link add name br%02d type bridge' % br_idx,
+            'link set br%02d up' % br_idx]
+
+
+def bridge_teardown_cmds(br_idx):
+    return ['link set br%02d down' % br_idx,
+            'link del br%02d' % br_idx]
+
+
+def bridge_exists(br_idx):
+    return os.path.exists('/sys/class/net/br%02d' % br_idx)
+
+
+# Bridges that the TAP backends of a VM are attached to, and that qrun
+# creates if missing
+def tap_bridges(args, num_backends):
+    bridges = []
+    for i in range(num_backends):
+        if args.backend_type[i] == 'tap' and args.bridging and \
+                args.bridge_create and args.br_idx[i] not in bridges:
+            bridges.append(args.br_idx[i])
+    return bridges
+
+
+# Host network commands to create the missing bridges in @bridges
+def bridges_setup_cmds(bridges):
+    cmds = []
+    for br_idx in bridges:
+        if not bridge_exists(br_idx):
+            cmds += bridge_setup_cmds(br_idx)
+    return cmds
+
+
+# Create the missing bridges in @bridges. Concurrent launches can race to
+# create the same bridge, so errors only matter if a bridge is still
+# missing afterwards.
+def bridges_setup(bridges):
+    try:
+        ip_batch(bridges_setup_cmds(bridges), force = True)
+    except subprocess.CalledProcessError:
+        if not all([bridge_exists(br_idx) for br_idx in bridges]):
+            raise
+
+
+# Host network commands to create the TAP backends of a VM
+def tap_setup_cmds(args, num_backends):
+    cmds = []
+    for i in range(num_backends):
+        if args.backend_type[i] != 'tap':
+            continue
+
+        backend_ifname = get_backend_ifname(args, i)
+        br_idx = args.br_idx[i]
+
+        cmd = 'tuntap add mode tap name %s' % backend_ifname
+        if args.queues[i] > 1:
+            cmd += ' multi_queue'
+        cmds.append(cmd)
+        cmds.append('link set %s up' % backend_ifname)
+
+        if args.bridging:
+            cmds.append('link set %s master br%02d' % (backend_ifname, br_idx))
+
+    return cmds
+
+
+# Host network commands to destroy the TAP backends of a VM
+def tap_teardown_cmds(args, num_backends):
+    cmds = []
+    for i in range(num_backends):
+        if args.backend_type[i] != 'tap':
+            continue
+
+        backend_ifname = get_backend_ifname(args, i)
+        cmds.append('link set %s down' % backend_ifname)
+        if args.bridging:
+            cmds.append('link set %s nomaster' % backend_ifname)
+
+        cmd = 'tuntap del mode tap name %s' % backend_ifname
+        if args.queues[i] > 1:
+            cmd += ' multi_queue'
+        cmds.append(cmd)
+
+    return cmds
+
+
+# Path of the vhost-user socket of data interface @i. The n-th vhost-user
+# interface uses the n-th --unix-socket, if given.
+def vhost_user_socket(args, i):
+    n = args.backend_type[:i].count('vhost-user')
+    if n < len(args.unix_socket):
+        return args.unix_socket[n]
+    return os.path.join(args.vhost_user_dir,
+                        'vm%d-%d.socket' % (args.mgmt_idx, args.idx[i]))
+
+
+# Wait for the unix sockets @paths to be created (by QEMU or by the
+# vhost-user switch). The sockets are not connected to, since a vhost-user
+# server only serves one client.
+def vhost_user_wait_sockets(paths, timeout):
+    deadline = time.time() + timeout
+    for path in paths:
+        while True:
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode):
+                    break
+            except OSError:
+                pass
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+    return True
+
+
+# Command line of the vhost-user switch connecting the interfaces with
+# sockets @sockets, each one with @queues queue pairs
+def vhost_user_switch_argv(args, sockets, queues):
+    if args.vhost_user_switch == 'testpmd':
+        argv = ['dpdk-testpmd', '--no-pci',
+                '--file-prefix', 'qrun%d' % args.mgmt_idx]
+        if args.vhost_user_switch_cpus:
+            argv += ['-l', args.vhost_user_switch_cpus]
+        for k in range(len(sockets)):
+            argv += ['--vdev', 'net_vhost%d,iface=%s,client=1,queues=%d' %
+                     (k, sockets[k], queues)]
+        # With the loop topology a single port forwards back to itself
+        argv += ['--', '--forward-mode=io', '--port-topology=loop',
+                 '--rxq=%d' % queues, '--txq=%d' % queues,
+                 '--stats-period', '10']
+    else:
+        subst = {'sockets': ' '.join(sockets)}
+        for k in range(len(sockets)):
+            subst['s%d' % k] = sockets[k]
+        try:
+            argv = shlex.split(args.vhost_user_switch % subst)
+        except (KeyError, ValueError) as e:
+            print("Invalid --vhost-user-switch command '%s': %s" %
+                  (args.vhost_user_switch, e))
+            quit(1)
+
+    if args.vhost_user_switch_cpus:
+        argv = ['taskset', '-c', args.vhost_user_switch_cpus] + argv
+
+    return argv
+
+
+def vhost_user_switch_start(plan):
+    args = plan.args
+    log = open(os.path.join(args.run_dir, 'vm%d-switch.log' % args.mgmt_idx),
+               'a')
+    try:
+        return subprocess.Popen(plan.vhost_user_switch,
+                                stdin = subprocess.DEVNULL,
+                                stdout = log, stderr = log)
+    finally:
+        log.close()
+
+
+def vhost_user_switch_stop(switch):
+    if switch.poll() is None:
+        switch.terminate()
+        try:
+            switch.wait(5)
+        except subprocess.TimeoutExpired:
+            switch.kill()
+            switch.wait()
+
+
+# Load a YAML (if PyYAML is available) or JSON configuration file
+def load_config(filename):
+    text = open(filename).read()
+    if filename.endswith('.json'):
+        return json.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        print("PyYAML is required to load %s (or use a JSON file)"
+              % filename)
+        quit(1)
+    return yaml.safe_load(text)
+
+
+# Load a topology file, in YAML (if PyYAML is available) or JSON format.
+#
+#   bridges: [1, 2]       # optional, additional bridges to create
+#   vms:
+#     - args: -i vm.qcow2 -m 10 -b tap -f virtio-net-pci --br-idx 1 -o none
+#     - args: [-i, vm.qcow2, -m, 11, -b, tap, --br-idx, 1, -o, none]
+#     - -i vm.qcow2 -m 12 -o none
+#   switches:             # optional, started once the VMs created their
+#                         # vhost-user sockets
+#     - snabb vm2vm /var/run/vm10-10.socket /var/run/vm11-11.socket
+#
+# Each VM is normalized into a dict with the 'argv' list.
+def topology_load(filename):
+    topo = load_config(filename)
+
+    if not isinstance(topo, dict) or not topo.get('vms'):
+        print("Topology %s does not describe any VM" % filename)
+        quit(1)
+
+    vms = []
+    for vm in topo['vms']:
+        if not isinstance(vm, dict):
+            vm = {'args': vm}
+        vmargs = vm.get('args', [])
+        if not isinstance(vmargs, list):
+            vmargs = shlex.split(vmargs)
+        vm['argv'] = [str(x) for x in vmargs]
+        vms.append(vm)
+    topo['vms'] = vms
+
+    return topo
+
+
+# Launch all the VMs of a topology: shared bridges are created once, VMs
+# are started in parallel (one qrun process each), then the switch
+# processes are started. Everything is torn down in reverse order.
+def run_topology(filename):
+    topo = topology_load(filename)
+
+    bridges = [int(b) for b in topo.get('bridges', [])]
+    # QEMU creates the vhost-user sockets of a VM one at a time, each
+    # once the previous one is connected: the switches are started when
+    # the first socket of each VM exists
+    sockets = []
+    wait = 0
+    for vm in topo['vms']:
+        vmargs = argparser.parse_args(vm['argv'])
+        vm_sockets = []
+        for i in range(complete_append_lists(argparser, vmargs)):
+            if vmargs.backend_type[i] == 'tap' and vmargs.bridging and \
+                    vmargs.br_idx[i] not in bridges:
+                bridges.append(vmargs.br_idx[i])
+            if vmargs.backend_type[i] == 'vhost-user' and \
+                    vmargs.unix_server and not vmargs.auto_idx:
+                vm_sockets.append(vhost_user_socket(vmargs, i))
+        sockets += vm_sockets[:1]
+        wait = max(wait, vmargs.vhost_user_wait)
+
+    qrun = [sys.executable, os.path.abspath(__file__)]
+
+    created = []
+    children = []
+    switches = []
+
+    def sigterm_handler(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    try:
+        created = [br_idx for br_idx in bridges if not bridge_exists(br_idx)]
+        cmds = []
+        for br_idx in created:
+            cmds += bridge_setup_cmds(br_idx)
+        ip_batch(cmds)
+
+        # Don't mistake stale sockets for the ones QEMU creates
+        if topo.get('switches'):
+            for path in sockets:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        for vm in topo['vms']:
+            children.append(subprocess.Popen(qrun + vm['argv'] +
+                                             ['--no-bridge-create'],
+                                             stdin = subprocess.DEVNULL))
+
+        if topo.get('switches') and \
+                not vhost_user_wait_sockets(sockets, wait):
+            print("The VMs did not create the vhost-user sockets %s, "
+                  "starting the switches anyway" % ' '.join(sockets))
+
+        for cmd in topo.get('switches', []):
+            switches.append(subprocess.Popen(cmd, shell=True))
+
+        print("Topology %s is up: %d VMs, %d bridges, %d switches" %
+              (filename, len(children), len(bridges), len(switches)))
+        for child in children:
+            child.wait()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for proc in reversed(switches + children):
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait()
+            except KeyboardInterrupt:
+                proc.kill()
+
+        cmds = []
+        for br_idx in reversed(created):
+            cmds += bridge_teardown_cmds(br_idx)
+        try:
+            ip_batch(cmds, force = True)
+        except subprocess.CalledProcessError:
+            print("Failed to destroy bridges %s" % created)
+
+
+# Run @cmd inside a guest through the SSH port forwarded by the
+# management network, and return its output
+def guest_ssh(port, user, cmd, check = True, timeout = None):
+    argv = ['ssh', '-p', '%d' % port, '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null', '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=5', '-o', 'LogLevel=ERROR',
+            '%s@127.0.0.1' % user, cmd]
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    try:
+        out = proc.communicate(timeout = timeout)[0]
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        out = proc.communicate()[0]
+    out = out.decode('utf-8', 'replace')
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out
+
+
+def guest_wait_ssh(port, user, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            guest_ssh(port, user, 'true', timeout = 10)
+            return True
+        except subprocess.CalledProcessError:
+            time.sleep(2)
+    return False
+
+
+# Name of the guest interface with MAC address @mac
+def guest_ifname(port, user, mac):
+    for line in guest_ssh(port, user, 'ip -o link').split('\n'):
+        if mac.lower() in line.lower():
+            return line.split(':')[1].strip().split('@')[0]
+    raise ValueError("No guest interface with MAC %s" % mac)
+
+
+# Busy and total jiffies of the host, from /proc/stat
+def host_cpu_times():
+    fields = [int(x) for x in open('/proc/stat').readline().split()[1:]]
+    idle = fields[3] + fields[4]
+    return sum(fields) - idle, sum(fields)
+
+
+def percentile(samples, p):
+    if len(samples) == 0:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+# The benchmark axes, with the qrun option to set them and their default
+bench_axes = [
+    ('backend_type', None, 'tap'),
+    ('frontend_type', None, 'virtio-net-pci'),
+    ('vhost_net', '--vhost-net', False),
+    ('mrg_rx_bufs', '--no-mrg-rx-bufs', True),
+    ('ioeventfd', '--no-ioeventfd', True),
+    ('interrupt_mitigation', '--interrupt-mitigation', False),
+]
+
+
+# Expand the benchmark matrix into a list of points, skipping the
+# combinations where a toggle does not apply to the backend/frontend
+def bench_points(matrix):
+    values = []
+    for name, opt, default in bench_axes:
+        v = matrix.get(name, [default])
+        values.append(v if isinstance(v, list) else [v])
+
+    points = []
+    for combo in itertools.product(*values):
+        point = dict(zip([axis[0] for axis in bench_axes], combo))
+        be, fe = point['backend_type'], point['frontend_type']
+        if be in ['nat', 'netmap-pipe-slave', 'socket-connect']:
+            continue
+        if be == 'vhost-user' and fe != 'virtio-net-pci':
+            continue
+        if point['vhost_net'] and (be != 'tap' or fe != 'virtio-net-pci'):
+            continue
+        if not point['mrg_rx_bufs'] and fe != 'virtio-net-pci':
+            continue
+        if not point['ioeventfd'] and \
+                fe not in ['virtio-net-pci', 'e1000-paravirt']:
+            continue
+        if point['interrupt_mitigation'] and \
+                fe not in ['e1000', 'e1000-paravirt']:
+            continue
+        points.append(point)
+
+    return points
+
+
+def bench_point_key(point):
+    return ','.join(['%s=%s' % (axis[0], point[axis[0]])
+                     for axis in bench_axes])
+
+
+# qrun arguments for the two ends of a benchmark point. The two VMs are
+# connected through bridge/VALE switch @br_idx.
+def bench_vm_argv(bench, point, mgmt_idx, peer_idx, side):
+    argv = list(bench['vm_argv'])
+    # The bridge is created once by run_bench()
+    argv += ['-m', '%d' % mgmt_idx, '-o', 'none',
+             '-f', point['frontend_type'], '--br-idx', '%d' % bench['br_idx'],
+             '--no-bridge-create']
+
+    be = point['backend_type']
+    if be == 'netmap-pipe-master':
+        be = 'netmap-pipe-master' if side == 0 else 'netmap-pipe-slave'
+        argv += ['--netmap', 'vale%d:pipe' % bench['br_idx']]
+    elif be == 'socket-listen':
+        be = 'socket-listen' if side == 0 else 'socket-connect'
+        argv += ['-n', '%d' % min(mgmt_idx, peer_idx)]
+    elif be == 'vhost-user':
+        argv += ['--unix-socket', bench['sockets'][side]]
+    argv += ['-b', be]
+
+    for name, opt, default in bench_axes:
+        if opt is not None and point[name] != default:
+            argv.append(opt)
+
+    return argv
+
+
+# Run the traffic generator between the guest with SSH port @tx_port and
+# the peer guest (or host) reachable at @rx_addr. Returns the measured
+# metrics.
+def bench_traffic(bench, tx_port, tx_if, rx_port, rx_if, rx_addr):
+    user = bench['ssh_user']
+    duration = bench['duration']
+    res = {'pps': None, 'gbps': None}
+
+    if bench['traffic'] == 'pkt-gen':
+        out = {}
+
+        def receiver():
+            out['rx'] = guest_ssh(rx_port, user, 'timeout %d pkt-gen -i %s '
+                                  '-f rx' % (duration + 2, rx_if),
+                                  check = False)
+
+        rx = threading.Thread(target = receiver)
+        rx.start()
+        time.sleep(1)
+        guest_ssh(tx_port, user, 'timeout %d pkt-gen -i %s -f tx -l %d'
+                  % (duration, tx_if, bench['pkt_len']), check = False)
+        rx.join()
+
+        rates = []
+        for m in re.finditer(r'([\d.]+)\s*([KMG]?)pps', out.get('rx', '')):
+            rates.append(float(m.group(1)) *
+                         {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9}[m.group(2)])
+        if rates:
+            res['pps'] = percentile(rates, 50)
+            res['gbps'] = res['pps'] * bench['pkt_len'] * 8 / 1e9
+
+    else:
+        if rx_port is not None:
+            guest_ssh(rx_port, user, 'iperf3 -s -D -1')
+        else:
+            subprocess.Popen(['iperf3', '-s', '-1', '-B', rx_addr],
+                             stdout=subprocess.DEVNULL)
+        time.sleep(1)
+        opts = ' -u -b 0 -l %d' % bench['pkt_len'] \
+                if bench['traffic'] == 'iperf3-udp' else ''
+        out = guest_ssh(tx_port, user, 'iperf3 -J -c %s -t %d%s' %
+                        (rx_addr, duration, opts))
+        summary = json.loads(out)['end']
+        if 'sum_received' in summary:
+            res['gbps'] = summary['sum_received']['bits_per_second'] / 1e9
+        else:
+            res['gbps'] = summary['sum']['bits_per_second'] / 1e9
+            res['pps'] = summary['sum']['packets'] / \
+                         summary['sum']['seconds']
+
+    out = guest_ssh(tx_port, user, 'ping -c %d -i 0.01 %s' %
+                    (bench['ping_count'], rx_addr), check = False)
+    rtts = [float(x) for x in re.findall(r'time=([\d.]+) ms', out)]
+    for p in [50, 90, 99]:
+        res['lat_p%d_us' % p] = percentile(rtts, p) * 1000 if rtts else None
+
+    return res
+
+
+# Boot the VM pair (or the VM and the host peer) of a benchmark point,
+# run the traffic and tear everything down
+def bench_run_point(bench, point):
+    qrun = [sys.executable, os.path.abspath(__file__)]
+    user = bench['ssh_user']
+    base = bench['mgmt_idx']
+    sides = [0] if bench['peer'] == 'host' else [0, 1]
+
+    vms = []
+    switch = None
+    host_addr = None
+    logf = open(bench['log'], 'a')
+    try:
+        if point['backend_type'] == 'vhost-user':
+            # Stale sockets would make the switch connect too early
+            for path in bench['sockets']:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        for side in sides:
+            argv = bench_vm_argv(bench, point, base + side,
+                                 base + 1 - side, side)
+            logf.write('### %s\n' % ' '.join(argv))
+            logf.flush()
+            vms.append(subprocess.Popen(qrun + argv, stdin=subprocess.DEVNULL,
+                                        stdout=logf, stderr=logf))
+            if side == 0 and len(sides) > 1 and \
+                    point['backend_type'] == 'socket-listen':
+                # The connecting side gives up if nobody listens yet. Both
+                # sides use data index @base (see bench_vm_argv())
+                port = 4000 + base
+                deadline = time.time() + bench['boot_timeout']
+                while tcp_port_free(port):
+                    if vms[0].poll() is not None or time.time() > deadline:
+                        raise ValueError("VM %d did not listen on port %d" %
+                                         (base, port))
+                    time.sleep(0.1)
+
+        if point['backend_type'] == 'vhost-user':
+            if not vhost_user_wait_sockets(bench['sockets'][:len(sides)],
+                                           bench['boot_timeout']):
+                raise ValueError("The vhost-user sockets of the VMs were "
+                                 "not created")
+            switch = subprocess.Popen(bench['vhost_user_switch'] %
+                                      {'a': bench['sockets'][0],
+                                       'b': bench['sockets'][1]},
+                                      shell=True, stdout=logf, stderr=logf)
+
+        ports = [bench['ssh_base_port'] + base + side for side in sides]
+        for port in ports:
+            if not guest_wait_ssh(port, user, bench['boot_timeout']):
+                raise ValueError("VM on SSH port %d did not boot" % port)
+
+        ifnames = []
+        for side in sides:
+            mac = '00:aa:bb:cc:%02x:%02x' % (base + side, base + side)
+            if point['backend_type'] == 'socket-listen':
+                mac = '00:aa:bb:cc:%02x:%02x' % (base + side, base)
+            ifname = guest_ifname(ports[side], user, mac)
+            guest_ssh(ports[side], user, 'ip addr flush dev %s; '
+                      'ip addr add 10.200.0.%d/24 dev %s; ip link set %s up'
+                      % (ifname, side + 1, ifname, ifname))
+            ifnames.append(ifname)
+
+        if bench['peer'] == 'host':
+            host_addr = '10.200.0.2/24 dev br%02d' % bench['br_idx']
+            ip_batch(['addr replace %s' % host_addr])
+            rx_port, rx_if = None, None
+        else:
+            rx_port, rx_if = ports[1], ifnames[1]
+
+        busy0, total0 = host_cpu_times()
+        res = bench_traffic(bench, ports[0], ifnames[0], rx_port, rx_if,
+                            '10.200.0.2')
+        busy1, total1 = host_cpu_times()
+        res['host_cpu_pct'] = 100.0 * (busy1 - busy0) / max(1, total1 - total0)
+
+    finally:
+        for proc in reversed(vms + ([switch] if switch else [])):
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+            proc.wait()
+        if host_addr:
+            try:
+                ip_batch(['addr del %s' % host_addr], force = True)
+            except subprocess.CalledProcessError:
+                pass
+        logf.close()
+
+    return res
+
+
+def bench_write_results(filename, results):
+    if filename.endswith('.csv'):
+        fields = [axis[0] for axis in bench_axes]
+        for res in results:
+            for k in res:
+                if k not in fields:
+                    fields.append(k)
+        with open(filename, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames = fields)
+            writer.writeheader()
+            for res in results:
+                writer.writerow(res)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+
+def bench_read_results(filename):
+    if not filename.endswith('.csv'):
+        return json.load(open(filename))
+
+    results = []
+    for row in csv.DictReader(open(filename)):
+        for k in row:
+            try:
+                row[k] = float(row[k])
+            except (TypeError, ValueError):
+                pass
+        results.append(row)
+    return results
+
+
+# Compare @results against a baseline. Returns the number of
+# regressions larger than @threshold percent.
+def bench_compare(results, baseline, threshold):
+    base = {}
+    for res in baseline:
+        base[bench_point_key(res)] = res
+
+    # For each metric, True if higher is better
+    metrics = [('pps', True), ('gbps', True), ('lat_p99_us', False),
+               ('host_cpu_pct', False)]
+
+    regressions = 0
+    print("%-70s %-12s %10s %10s %8s" % ('point', 'metric', 'baseline',
+                                          'current', 'delta'))
+    for res in results:
+        key = bench_point_key(res)
+        if key not in base:
+            continue
+        for metric, higher_better in metrics:
+            old, new = base[key].get(metric), res.get(metric)
+            if old in [None, ''] or new in [None, ''] or float(old) == 0:
+                continue
+            delta = 100.0 * (float(new) - float(old)) / float(old)
+            bad = (delta < -threshold) if higher_better else \
+                  (delta > threshold)
+            if bad:
+                regressions += 1
+            print("%-70s %-12s %10.3f %10.3f %+7.1f%%%s" %
+                  (key, metric, float(old), float(new), delta,
+                   ' REGRESSION' if bad else ''))
+
+    return regressions
+
+
+# Entry point for "qrun bench": sweep a matrix of backend/frontend
+# configurations described in a YAML/JSON file like the following one
+#
+#   vm: -i ~/git/vm/netmap.qcow2 --memory 1G --temp
+#   peer: vm                # or 'host' (TAP backend only)
+#   traffic: iperf3         # or 'iperf3-udp', 'pkt-gen'
+#   duration: 10
+#   matrix:
+#     backend_type: [tap, netmap]
+#     frontend_type: [virtio-net-pci, e1000]
+#     vhost_net: [false, true]
+#     interrupt_mitigation: [false, true]
+#   vhost_user_switch: snabb vm2vm %(a)s %(b)s
+def run_bench(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun bench',
+                        description = "Network throughput benchmark over "
+                                      "a matrix of backend/frontend "
+                                      "configurations")
+    parser.add_argument('config', help = "Benchmark description file")
+    parser.add_argument('-r', '--results', type = str,
+                        default = 'qrun-bench.json',
+                        help = "Results file (.json or .csv)")
+    parser.add_argument('--baseline', type = str,
+                        help = "Compare the results against this results file")
+    parser.add_argument('--threshold', type = float, default = 5.0,
+                        help = "Regression threshold, in percent")
+    parser.add_argument('--dry-run', action='store_true',
+                        help = "Only show the VM command lines of each point")
+    bargs = parser.parse_args(argv)
+
+    bench = {'peer': 'vm', 'traffic': 'iperf3', 'duration': 10,
+             'pkt_len': 60, 'ping_count': 500, 'ssh_user': 'root',
+             'ssh_base_port': 20000, 'mgmt_idx': 50, 'br_idx': 50,
+             'boot_timeout': 300, 'matrix': {}, 'log': 'qrun-bench.log',
+             'vhost_user_switch': None}
+    bench.update(load_config(bargs.config))
+    bench['vm_argv'] = bench['vm'] if isinstance(bench['vm'], list) \
+                        else shlex.split(bench['vm'])
+    bench['vm_argv'] += ['-p', '%d' % bench['ssh_base_port']]
+    bench['sockets'] = ['/var/run/vm%d-%d.socket' % (bench['mgmt_idx'] + i,
+                        bench['mgmt_idx'] + i) for i in [0, 1]]
+
+    points = bench_points(bench['matrix'])
+    if bench['peer'] == 'host':
+        if bench['traffic'] == 'pkt-gen':
+            print("pkt-gen traffic requires a VM peer")
+            quit(1)
+        points = [p for p in points if p['backend_type'] == 'tap']
+    if not bench['vhost_user_switch']:
+        points = [p for p in points if p['backend_type'] != 'vhost-user']
+
+    if bargs.dry_run:
+        for point in points:
+            print(bench_point_key(point))
+            for side in ([0] if bench['peer'] == 'host' else [0, 1]):
+                print("    qrun %s" % ' '.join(bench_vm_argv(bench, point,
+                      bench['mgmt_idx'] + side, bench['mgmt_idx'] + 1 - side,
+                      side)))
+        return
+
+    # Both VMs of a point share the bridge: create it once, rather than
+    # letting them race to create it
+    bridge = None
+    if any([p['backend_type'] == 'tap' for p in points]) and \
+            not bridge_exists(bench['br_idx']):
+        bridge = bench['br_idx']
+        bridges_setup([bridge])
+
+    results = []
+    try:
+        for n in range(len(points)):
+            point = points[n]
+            print("[%d/%d] %s" % (n + 1, len(points),
+                                  bench_point_key(point)))
+            res = dict(point)
+            try:
+                res.update(bench_run_point(bench, point))
+            except (ValueError, KeyError,
+                    subprocess.CalledProcessError) as e:
+                print("    failed: %s" % e)
+                res['error'] = str(e)
+            print("    %s" % ', '.join(['%s=%s' % (k, res[k]) for k in res
+                                        if k not in point]))
+            results.append(res)
+            # Save partial results, a full sweep may take hours
+            bench_write_results(bargs.results, results)
+    finally:
+        if bridge is not None:
+            try:
+                ip_batch(bridge_teardown_cmds(bridge), force = True)
+            except subprocess.CalledProcessError:
+                pass
+
+    if bargs.baseline:
+        if bench_compare(results, bench_read_results(bargs.baseline),
+                         bargs.threshold) > 0:
+            quit(1)
+
+
+# True if an SSH server answers on the local TCP port @port. A plain
+# connect() is not enough, as the user-mode network accepts forwarded
+# connections even before the guest is listening.
+def ssh_banner_ready(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(1)
+    try:
+        sock.connect(('127.0.0.1', port))
+        return sock.recv(4) == b'SSH-'
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+
+
+# Measure the boot of a VM launched at time @t0: time until the QMP
+# socket shows up, until the first serial console output, until the
+# console marker and until the SSH server answers on the mgmt port
+def measure_boot(args, t0, timeout = 300):
+    marks = {'qemu': None, 'console': None, 'marker': None, 'ssh': None}
+    ssh_port = args.ssh_base_port + args.mgmt_idx
+    console = ''
+    consf = None
+
+    while time.time() - t0 < timeout:
+        now = time.time() - t0
+        if marks['qemu'] is None and os.path.exists(args.qmp_socket):
+            marks['qemu'] = now
+        if consf is None and os.path.exists(args.console_file):
+            consf = open(args.console_file, 'rb')
+        if consf is not None and marks['marker'] is None:
+            console += consf.read().decode('utf-8', 'replace')
+            if console and marks['console'] is None:
+                marks['console'] = now
+            if args.boot_marker in console:
+                marks['marker'] = now
+        if args.mgmtnet and marks['ssh'] is None and ssh_banner_ready(ssh_port):
+            marks['ssh'] = time.time() - t0
+        if marks['marker'] is not None and \
+                (marks['ssh'] is not None or not args.mgmtnet):
+            break
+        time.sleep(0.02)
+
+    if consf is not None:
+        consf.close()
+
+    print("Boot time: %s" % ', '.join(['%s %s' % (k, '%.3fs' % marks[k]
+                                       if marks[k] is not None else 'n/a')
+                                       for k in ['qemu', 'console', 'marker',
+                                                 'ssh']]))
+    if args.boot_report:
+        report = {'ts': t0, 'mgmt_idx': args.mgmt_idx,
+                  'machine': args.machine, 'kernel': args.kernel,
+                  'kernel_cmdline': args.kernel_cmdline,
+                  'marker': args.boot_marker}
+        for k in marks:
+            report['%s_s' % k] = marks[k]
+        with open(args.boot_report, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+# Path of the state file of VM @mgmt_idx. The state file describes a
+# running VM (QEMU pid, control sockets, data interfaces), so that other
+# qrun commands can find it.
+def vm_state_path(run_dir, mgmt_idx):
+    return os.path.join(run_dir, 'vm%d.json' % mgmt_idx)
+
+
+def vm_state_save(args, num_backends, pid):
+    interfaces = []
+    for i in range(num_backends):
+        interfaces.append({'idx': args.idx[i], 'br_idx': args.br_idx[i],
+                           'backend': args.backend_type[i],
+                           'frontend': args.frontend_type[i],
+                           'ifname': get_backend_ifname(args, i),
+                           'queues': args.queues[i],
+                           'vhost': args.vhost_net and
+                                    args.backend_type[i] == 'tap' and
+                                    args.frontend_type[i] == 'virtio-net-pci',
+                           'mac': '00:aa:bb:cc:%02x:%02x' % (args.mgmt_idx,
+                                                             args.idx[i])})
+    state = {'mgmt_idx': args.mgmt_idx, 'pid': pid, 'qrun_pid': os.getpid(),
+             'qmp': args.qmp_socket, 'interfaces': interfaces,
+             'ssh_port': args.ssh_base_port + args.mgmt_idx,
+             'pci_passthrough': args.pci_passthrough,
+             'guest_agent': args.guest_agent_socket if args.guest_agent
+                            else None,
+             'argv': getattr(args, 'qrun_argv', None), 'cwd': os.getcwd(),
+             'run_dir': args.run_dir,
+             'image': os.path.abspath(args.image) if args.image else None,
+             'disk_format': args.disk_format,
+             'temp_overlay': bool(args.image and (args.pool_restore or
+                                  args.own_image or
+                                  args.temp_mode and not args.keep_overlay)),
+             'supervisor': getattr(args, 'supervisor', None),
+             'tuning': {'vhost_net': args.vhost_net,
+                        'ioeventfd': args.ioeventfd,
+                        'interrupt_mitigation': args.interrupt_mitigation,
+                        'mrg_rx_bufs': args.mrg_rx_bufs}}
+    filename = vm_state_path(args.run_dir, args.mgmt_idx)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent = 2)
+    os.rename(filename + '.tmp', filename)
+    return state
+
+
+# Load the state of a running VM, given its management index
+def vm_state_load(run_dir, mgmt_idx):
+    try:
+        return json.load(open(vm_state_path(run_dir, mgmt_idx)))
+    except (IOError, ValueError):
+        print("VM %d is not running (no state in %s)" % (mgmt_idx, run_dir))
+        quit(1)
+
+
+# States of all the VMs that have a state file in @run_dir and whose
+# QEMU process is still alive
+def vm_states_running(run_dir):
+    states = []
+    try:
+        entries = sorted(os.listdir(run_dir))
+    except OSError:
+        return states
+    for entry in entries:
+        if not re.match(r'^vm\d+\.json$', entry):
+            continue
+        try:
+            state = json.load(open(os.path.join(run_dir, entry)))
+        except (IOError, ValueError):
+            continue
+        if os.path.exists('/proc/%d' % state['pid']):
+            states.append(state)
+    return states
+
+
+# CPU time (in seconds) consumed by thread @tid of process @pid
+def thread_cpu_seconds(pid, tid):
+    stat = open('/proc/%d/task/%d/stat' % (pid, tid)).read()
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / \
+            float(os.sysconf('SC_CLK_TCK'))
+
+
+def netdev_counters(ifname):
+    counters = {}
+    for name in ['rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+                 'rx_dropped', 'tx_dropped']:
+        try:
+            counters[name] = int(open('/sys/class/net/%s/statistics/%s' %
+                                      (ifname, name)).read())
+        except IOError:
+            pass
+    return counters
+
+
+# Collect the runtime statistics of a VM, as a list of
+# (metric, labels, value) samples
+def vm_stats_collect(state, qmp, qga = None):
+    vm = '%d' % state['mgmt_idx']
+    samples = []
+
+    for vcpu in qmp.command('query-cpus-fast'):
+        try:
+            secs = thread_cpu_seconds(state['pid'], vcpu['thread-id'])
+        except IOError:
+            continue
+        samples.append(('qrun_vcpu_cpu_seconds_total',
+                        {'vm': vm, 'vcpu': '%d' % vcpu['cpu-index']}, secs))
+
+    for blk in qmp.command('query-blockstats'):
+        dev = blk.get('device') or blk.get('qdev', '')
+        for name in ['rd_bytes', 'wr_bytes', 'rd_operations',
+                     'wr_operations', 'flush_operations']:
+            samples.append(('qrun_block_%s_total' % name,
+                            {'vm': vm, 'device': dev}, blk['stats'][name]))
+
+    try:
+        balloon = qmp.command('query-balloon')
+        samples.append(('qrun_balloon_actual_bytes', {'vm': vm},
+                        balloon['actual']))
+    except QMPError:
+        # No balloon device
+        pass
+
+    for intf in state['interfaces']:
+        labels = {'vm': vm, 'ifname': intf['ifname'],
+                  'backend': intf['backend'], 'frontend': intf['frontend']}
+        counters = netdev_counters(intf['ifname'])
+        for name in sorted(counters):
+            samples.append(('qrun_host_if_%s_total' % name, labels,
+                            counters[name]))
+
+    # Guest-side interface counters, if the guest agent is available
+    if qga is not None:
+        macs = {}
+        for intf in state['interfaces']:
+            macs[intf['mac']] = intf['ifname']
+        for gif in qga.command('guest-network-get-interfaces'):
+            mac = gif.get('hardware-address', '').lower()
+            if mac not in macs or 'statistics' not in gif:
+                continue
+            labels = {'vm': vm, 'ifname': macs[mac], 'guest_if': gif['name']}
+            for name, value in sorted(gif['statistics'].items()):
+                samples.append(('qrun_guest_if_%s_total' %
+                                name.replace('-', '_'), labels, value))
+
+    return samples
+
+
+def format_prometheus(samples):
+    lines = []
+    typed = set()
+    for name, labels, value in samples:
+        if name not in typed:
+            typed.add(name)
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines.append('# TYPE %s %s' % (name, kind))
+        lbl = ','.join(['%s="%s"' % (k, labels[k]) for k in sorted(labels)])
+        lines.append('%s{%s} %s' % (name, lbl, value))
+    return '\n'.join(lines) + '\n'
+
+
+def format_json(samples):
+    return json.dumps({'ts': time.time(),
+                       'samples': [{'name': name, 'labels': labels,
+                                    'value': value}
+                                   for name, labels, value in samples]})
+
+
+# Collect one sample of the statistics of a VM. The QMP and guest agent
+# sockets serve a single client, so they are only held for the sample.
+def vm_stats_sample(state):
+    qmp = QMP(state['qmp'], timeout = 1, reply_timeout = 5)
+    qga = None
+    try:
+        if state.get('guest_agent'):
+            try:
+                qga = QMP(state['guest_agent'], greeting = False,
+                          timeout = 1, reply_timeout = 5)
+            except QMPError:
+                pass
+        return vm_stats_collect(state, qmp, qga)
+    finally:
+        qmp.close()
+        if qga is not None:
+            qga.close()
+
+
+# Periodically export the statistics of a VM, until @stop is set or the
+# VM goes away. Prometheus text is written to @output atomically (for
+# the node_exporter textfile collector), JSON lines are appended.
+def vm_stats_loop(state, interval, fmt, output, stop = None, once = False):
+    while stop is None or not stop.is_set():
+        try:
+            samples = vm_stats_sample(state)
+        except (QMPError, IOError):
+            if not pid_alive(state['pid']):
+                break
+            # QMP busy with another client, skip this sample
+            samples = None
+        if samples is not None:
+            if fmt == 'prometheus':
+                text = format_prometheus(samples)
+                if output:
+                    with open(output + '.tmp', 'w') as f:
+                        f.write(text)
+                    os.rename(output + '.tmp', output)
+                else:
+                    sys.stdout.write(text)
+            else:
+                text = format_json(samples) + '\n'
+                if output:
+                    with open(output, 'a') as f:
+                        f.write(text)
+                else:
+                    sys.stdout.write(text)
+            sys.stdout.flush()
+        if once:
+            break
+        if stop is not None:
+            stop.wait(interval)
+        else:
+            time.sleep(interval)
+
+
+# Entry point for "qrun stats <vm>"
+def run_stats(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun stats',
+                        description = "Export the runtime statistics of a "
+                                      "running VM")
+    parser.add_argument('vm', type = int,
+                        help = "Management index of the VM (-m)")
+    add_stats_arguments(parser)
+    parser.add_argument('--once', action='store_true',
+                        help = "Print a single sample and exit")
+    sargs = parser.parse_args(argv)
+
+    state = vm_state_load(sargs.run_dir, sargs.vm)
+    try:
+        vm_stats_loop(state, sargs.stats_interval, sargs.stats_format,
+                      sargs.stats_output, once = sargs.once)
+    except KeyboardInterrupt:
+        pass
+
+
+def add_run_dir_argument(parser):
+    parser.add_argument('--run-dir', type = str, default = '/tmp/qrun',
+                        help = "Directory for the QMP sockets and the "
+                               "state of the running VMs")
+
+
+def add_stats_arguments(parser):
+    add_run_dir_argument(parser)
+    parser.add_argument('--stats-interval', type = float, default = 5,
+                        help = "Statistics polling interval, in seconds")
+    parser.add_argument('--stats-format', choices = ['prometheus', 'json'],
+                        default = 'json',
+                        help = "Statistics output format")
+    parser.add_argument('--stats-output', type = str,
+                        help = "Statistics output file (stdout by default)")
+
+
+SIOCETHTOOL = 0x8946
+ETHTOOL_GSTRINGS = 0x1b
+ETHTOOL_GSTATS = 0x1d
+ETHTOOL_GSSET_INFO = 0x37
+ETH_SS_STATS = 1
+ETH_GSTRING_LEN = 32
+
+
+# Run the ethtool command in @buf (an array of bytes, updated in place by
+# the kernel) on interface @ifname
+def ethtool_ioctl(sock, ifname, buf):
+    ifr = struct.pack('16sP', ifname.encode('ascii'), buf.buffer_info()[0])
+    fcntl.ioctl(sock.fileno(), SIOCETHTOOL, ifr + b'\0' * (40 - len(ifr)))
+
+
+# Names of the driver statistics of @ifname (as in "ethtool -S")
+def ethtool_stat_names(sock, ifname):
+    buf = array.array('B', struct.pack('IIQI', ETHTOOL_GSSET_INFO, 0,
+                                       1 << ETH_SS_STATS, 0))
+    ethtool_ioctl(sock, ifname, buf)
+    n = struct.unpack('IIQI', buf.tobytes())[3]
+
+    buf = array.array('B', struct.pack('III', ETHTOOL_GSTRINGS, ETH_SS_STATS,
+                                       n) + b'\0' * (ETH_GSTRING_LEN * n))
+    ethtool_ioctl(sock, ifname, buf)
+    data = buf.tobytes()[12:]
+    return [data[k * ETH_GSTRING_LEN:(k + 1) * ETH_GSTRING_LEN]
+            .split(b'\0')[0].decode('ascii', 'replace') for k in range(n)]
+
+
+# Counters of a host interface, overall and per queue. The sysfs counters
+# are read through file descriptors kept open, and the per-queue driver
+# statistics through the ethtool ioctl, so that sampling at a high rate
+# does not fork or open files.
+class NetdevSampler:
+    COUNTERS = ['rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+                'rx_dropped', 'tx_dropped']
+    # e.g. rx_queue_0_packets, rx0_packets, tx-1.bytes, rx0_drops
+    QUEUE_STAT = re.compile(r'^(rx|tx)(?:_queue_|_|-)?(\d+)[_.]'
+                            r'(packets|bytes|drops|dropped)$')
+
+    def __init__(self, sock, ifname):
+        self.sock = sock
+        self.ifname = ifname
+        self.fds = []
+        try:
+            for name in self.COUNTERS:
+                self.fds.append(os.open('/sys/class/net/%s/statistics/%s' %
+                                        (ifname, name), os.O_RDONLY))
+        except OSError:
+            self.close()
+            raise
+
+        # Each entry is (statistic index, queue, counter)
+        self.queue_stats = []
+        try:
+            names = ethtool_stat_names(sock, ifname)
+        except (IOError, OSError):
+            # No driver statistics (e.g. TAP devices)
+            names = []
+        for k in range(len(names)):
+            m = self.QUEUE_STAT.match(names[k])
+            if m:
+                counter = {'drops': 'dropped'}.get(m.group(3), m.group(3))
+                self.queue_stats.append((k, '%s%s' % (m.group(1), m.group(2)),
+                                         counter))
+        self.stats_buf = None
+        if self.queue_stats:
+            self.stats_buf = array.array('B', struct.pack('II', ETHTOOL_GSTATS,
+                                                          len(names)) +
+                                              b'\0' * (8 * len(names)))
+            self.num_stats = len(names)
+
+    def sample(self):
+        counters = {}
+        for k in range(len(self.COUNTERS)):
+            counters[self.COUNTERS[k]] = int(os.pread(self.fds[k], 32, 0))
+
+        queues = {}
+        if self.stats_buf is not None:
+            ethtool_ioctl(self.sock, self.ifname, self.stats_buf)
+            values = struct.unpack_from('%dQ' % self.num_stats,
+                                        self.stats_buf, 8)
+            for k, queue, counter in self.queue_stats:
+                queues.setdefault(queue, {})[counter] = values[k]
+
+        return counters, queues
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+# Host interfaces of the running VMs that have a network device (TAPs,
+# NICs used by netmap), and the bridges the TAPs are attached to, as
+# (owner, ifname, backend) tuples
+def top_interfaces(run_dir):
+    ifaces = []
+    bridges = []
+    for state in vm_states_running(run_dir):
+        for intf in state['interfaces']:
+            if os.path.isdir('/sys/class/net/%s' % intf['ifname']):
+                ifaces.append(('vm%d' % state['mgmt_idx'], intf['ifname'],
+                               intf['backend']))
+            br = 'br%02d' % intf['br_idx']
+            if intf['backend'] == 'tap' and br not in bridges and \
+                    os.path.isdir('/sys/class/net/%s' % br):
+                bridges.append(br)
+    return ifaces + [('bridges', br, 'bridge') for br in sorted(bridges)]
+
+
+# Per-second rates between the samples @prev and @cur of an interface
+def top_rates(prev, cur, dt):
+    def rate(old, new):
+        # Counters restart when an interface is recreated
+        return max(new - old, 0) / dt
+
+    counters, queues = cur
+    row = {'rx_pps': rate(prev[0]['rx_packets'], counters['rx_packets']),
+           'tx_pps': rate(prev[0]['tx_packets'], counters['tx_packets']),
+           'rx_bps': 8 * rate(prev[0]['rx_bytes'], counters['rx_bytes']),
+           'tx_bps': 8 * rate(prev[0]['tx_bytes'], counters['tx_bytes']),
+           'rx_drops': rate(prev[0]['rx_dropped'], counters['rx_dropped']),
+           'tx_drops': rate(prev[0]['tx_dropped'], counters['tx_dropped']),
+           'queues': {}}
+    for queue in sorted(queues):
+        if queue not in prev[1]:
+            continue
+        qrow = {}
+        for counter, value in queues[queue].items():
+            name = {'packets': 'pps', 'bytes': 'bps',
+                    'dropped': 'drops'}[counter]
+            qrow[name] = rate(prev[1][queue].get(counter, value), value)
+            if name == 'bps':
+                qrow[name] *= 8
+        row['queues'][queue] = qrow
+    return row
+
+
+def format_rate(value):
+    for unit, scale in [('G', 1e9), ('M', 1e6), ('K', 1e3)]:
+        if value >= scale:
+            return '%.2f%s' % (value / scale, unit)
+    return '%.0f' % value
+
+
+# Draw the rows of a sample on the curses screen @scr
+def top_draw(scr, rows, interval):
+    scr.erase()
+    height, width = scr.getmaxyx()
+    lines = ['qrun top - %d interfaces, every %.2fs (q to quit)' %
+             (len(rows), interval), '',
+             '%-16s %-10s %10s %10s %10s %10s %9s %9s' %
+             ('INTERFACE', 'BACKEND', 'RX pps', 'TX pps', 'RX bps',
+              'TX bps', 'RX drop', 'TX drop')]
+    fields = ['rx_pps', 'tx_pps', 'rx_bps', 'tx_bps', 'rx_drops', 'tx_drops']
+    owner = None
+    for row in rows:
+        if row['owner'] != owner:
+            owner = row['owner']
+            group = [r for r in rows if r['owner'] == owner]
+            totals = [format_rate(sum([r[f] for r in group])) for f in fields]
+            lines.append('%-27s %10s %10s %10s %10s %9s %9s' %
+                         tuple([owner] + totals))
+        lines.append('  %-14s %-10s %10s %10s %10s %10s %9s %9s' %
+                     tuple([row['ifname'], row['backend']] +
+                           [format_rate(row[f]) for f in fields]))
+        for queue in sorted(row['queues']):
+            q = row['queues'][queue]
+            direction = 0 if queue.startswith('rx') else 1
+            cols = ['', '', '', '', '', '']
+            cols[direction] = format_rate(q.get('pps', 0))
+            cols[direction + 2] = format_rate(q.get('bps', 0))
+            cols[direction + 4] = format_rate(q.get('drops', 0))
+            lines.append('    %-12s %-10s %10s %10s %10s %10s %9s %9s' %
+                         tuple([queue, ''] + cols))
+    for y in range(min(len(lines), height)):
+        scr.addstr(y, 0, lines[y][:width - 1])
+    scr.refresh()
+
+
+# Sample all the interfaces every @interval seconds, and pass the rows of
+# each sample to @output. The interface list is refreshed every second,
+# so that VMs can come and go.
+def top_loop(run_dir, interval, output, count = None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    samplers = {}
+    owners = {}
+    prev = {}
+    last_scan = 0
+    n = 0
     try:
-        cwd = os.getcwd()
-        os.chdir("/sys/bus/pci/devices/0000:%s/driver" % pcidev)
-        dricwd = os.getcwd()
-        os.chdir(cwd)
-    except:
-        return args.pci_passthrough_driver
+        while count is None or n <= count:
+            now = time.time()
+            if now - last_scan >= 1:
+                last_scan = now
+                found = {}
+                for owner, ifname, backend in top_interfaces(run_dir):
+                    found[ifname] = (owner, backend)
+                for ifname in list(samplers):
+                    if ifname not in found:
+                        samplers.pop(ifname).close()
+                        prev.pop(ifname, None)
+                for ifname in found:
+                    if ifname not in samplers:
+                        try:
+                            samplers[ifname] = NetdevSampler(sock, ifname)
+                        except OSError:
+                            continue
+                owners = found
+
+            rows = []
+            for ifname in list(samplers):
+                try:
+                    cur = samplers[ifname].sample()
+                except (IOError, OSError, ValueError):
+                    # The interface went away
+                    samplers.pop(ifname).close()
+                    prev.pop(ifname, None)
+                    continue
+                if ifname in prev:
+                    row = top_rates(prev[ifname][1], cur,
+                                    now - prev[ifname][0])
+                    row['owner'], row['backend'] = owners[ifname]
+                    row['ifname'] = ifname
+                    rows.append(row)
+                prev[ifname] = (now, cur)
+
+            if n > 0 or not samplers:
+                rows.sort(key = lambda r: (r['owner'] == 'bridges',
+                                           r['owner'], r['ifname']))
+                if output(now, rows) is False:
+                    break
+            n += 1
+            time.sleep(max(interval - (time.time() - now), 0))
+    finally:
+        for sampler in samplers.values():
+            sampler.close()
+        sock.close()
+
+
+# Entry point for "qrun top"
+def run_top(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun top',
+                        description = "Show the traffic on the host "
+                                      "interfaces of the running VMs")
+    add_run_dir_argument(parser)
+    parser.add_argument('-i', '--interval', type = float, default = 1,
+                        help = "Sampling interval, in seconds")
+    parser.add_argument('--json', action='store_true',
+                        help = "Stream JSON lines rather than showing a "
+                               "curses view")
+    parser.add_argument('-c', '--count', type = int,
+                        help = "Exit after COUNT updates")
+    targs = parser.parse_args(argv)
+
+    if targs.json:
+        def output(ts, rows):
+            sys.stdout.write(json.dumps({'ts': ts, 'interfaces': rows}) +
+                             '\n')
+            sys.stdout.flush()
 
-    return os.path.basename(os.path.normpath(dricwd))
+        try:
+            top_loop(targs.run_dir, targs.interval, output, targs.count)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    import curses
 
+    def view(scr):
+        curses.curs_set(0)
+        scr.nodelay(True)
 
-# Unbind the given host PCI device from its current driver
-# and bind it to a new driver
-def pci_driver_rebind(args, pcidev, newdr = None):
+        def output(ts, rows):
+            top_draw(scr, rows, targs.interval)
+            return scr.getch() not in [ord('q'), ord('Q')]
 
-    if newdr is None:
-        newdr = args.pci_passthrough_driver
+        top_loop(targs.run_dir, targs.interval, output, targs.count)
 
     try:
-        out = subprocess.check_output(["lspci", "-n"])
-        out = out.decode('ascii').split('\n')
-    except:
-        print("Failed to execute 'lspci' command")
-        quit(1)
+        curses.wrapper(view)
+    except KeyboardInterrupt:
+        pass
+
+
+KVM_DEBUGFS = '/sys/kernel/debug/kvm'
+
+# Guest script printing the name, MAC and device of each interface,
+# followed by the interrupt counters
+GUEST_IRQ_SCRIPT = 'for d in /sys/class/net/*; do ' \
+                   'echo "dev $(basename $d) $(cat $d/address) ' \
+                   '$(basename $(readlink -f $d/device) 2>/dev/null)"; ' \
+                   'done; cat /proc/interrupts'
+
+
+# KVM statistics directory of the QEMU process @pid in debugfs. There is
+# one per VM file descriptor, named <pid>-<fd>.
+def kvm_debugfs_dir(pid):
+    try:
+        entries = sorted(os.listdir(KVM_DEBUGFS))
+    except OSError:
+        return None
+    for entry in entries:
+        if entry.split('-')[0] == '%d' % pid:
+            return os.path.join(KVM_DEBUGFS, entry)
+    return None
+
+
+# Exit and interrupt injection counters of a VM, summed over its vCPUs
+def kvm_exit_counters(path):
+    counters = {}
+    for name in os.listdir(path):
+        if not name.endswith('exits') and name != 'irq_injections':
+            continue
+        try:
+            counters[name] = int(open(os.path.join(path, name)).read())
+        except (IOError, ValueError):
+            pass
+    return counters
+
+
+# Parse /proc/interrupts (or its copy in @text) into a list of (IRQ,
+# name, count summed over all CPUs), the name being the last column
+def interrupt_counts(text = None):
+    if text is None:
+        text = open('/proc/interrupts').read()
+    lines = text.strip().split('\n')
+    ncpus = len(lines[0].split())
+    counts = []
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) < ncpus + 2 or not fields[0].rstrip(':').isdigit():
+            continue
+        total = sum([int(x) for x in fields[1:ncpus + 1] if x.isdigit()])
+        counts.append((int(fields[0].rstrip(':')), fields[-1], total))
+    return counts
+
+
+# Interrupts received by the guest NICs, by MAC address. virtio-net
+# vectors are named after the virtio device (e.g. virtio2-input.0), the
+# other drivers name them after the interface.
+def guest_nic_interrupts(port, user, macs):
+    out = guest_ssh(port, user, GUEST_IRQ_SCRIPT, timeout = 30)
+    names = {}
+    lines = out.split('\n')
+    while lines and lines[0].startswith('dev '):
+        fields = lines.pop(0).split() + ['']
+        names[fields[2].lower()] = (fields[1], fields[3])
+
+    counts = dict([(mac, 0) for mac in macs])
+    irqs = interrupt_counts('\n'.join(lines))
+    for mac in macs:
+        if mac.lower() not in names:
+            continue
+        ifname, dev = names[mac.lower()]
+        for irq, name, total in irqs:
+            if name == ifname or name.startswith(ifname + '-') or \
+                    (dev.startswith('virtio') and
+                     name.startswith(dev + '-')):
+                counts[mac] += total
+    return counts
+
+
+# Start recording the KVM exits of the QEMU process @pid to @path
+def perf_kvm_record(pid, path):
+    return subprocess.Popen(['perf', 'kvm', 'stat', 'record', '-q',
+                             '-o', path, '-p', '%d' % pid],
+                            stdout = subprocess.DEVNULL,
+                            stderr = subprocess.DEVNULL)
+
+
+# Stop the perf recording @proc and report the exit reasons as a list of
+# (reason, count, time share, average time in microseconds)
+def perf_kvm_report(proc, path):
+    proc.send_signal(signal.SIGINT)
+    proc.wait()
+    out = subprocess.check_output(['perf', 'kvm', 'stat', 'report',
+                                   '-i', path, '--event=vmexit'],
+                                  stderr = subprocess.DEVNULL)
+    os.unlink(path)
+    reasons = []
+    for line in out.decode('utf-8', 'replace').split('\n'):
+        m = re.match(r'^\s*(\S+)\s+(\d+)\s+[\d.]+%\s+([\d.]+)%\s+[\d.]+us'
+                     r'\s+[\d.]+us\s+([\d.]+)us', line)
+        if m:
+            reasons.append((m.group(1), int(m.group(2)),
+                            float(m.group(3)), float(m.group(4))))
+    return reasons
+
+
+# Snapshot of the counters of a VM used by "qrun profile"
+def profile_sample(state, tids, kvm_dir, msix, guest_user):
+    sample = {'time': time.time(), 'cpu': {}, 'kvm': {}, 'msix': {},
+              'netdev': {}, 'guest_irqs': None}
+    for tid in tids:
+        try:
+            # Also valid for vhost kernel threads outside of QEMU
+            sample['cpu'][tid] = thread_cpu_seconds(tid, tid)
+        except IOError:
+            pass
+    if kvm_dir:
+        sample['kvm'] = kvm_exit_counters(kvm_dir)
+    if msix:
+        irqs = interrupt_counts()
+        for pcidev in msix:
+            sample['msix'][pcidev] = sum([total for irq, name, total in irqs
+                                          if irq in msix[pcidev]])
+    for intf in state['interfaces']:
+        counters = netdev_counters(intf['ifname'])
+        sample['netdev'][intf['ifname']] = counters.get('rx_packets', 0) + \
+                                           counters.get('tx_packets', 0)
+    if guest_user:
+        try:
+            sample['guest_irqs'] = guest_nic_interrupts(state['ssh_port'],
+                    guest_user, [intf['mac'] for intf in state['interfaces']])
+        except subprocess.CalledProcessError:
+            pass
+    return sample
+
+
+# Profile a running VM for @duration seconds: KVM exits (by counter, or by
+# reason with @perf), CPU time of the QEMU and vhost threads, host MSI-X
+# interrupts of the passthrough devices and guest interrupts of the NICs
+def vm_profile(state, duration, perf = False, guest_user = None):
+    pid = state['pid']
+    qmp = QMP(state['qmp'])
+    try:
+        vcpus = dict([(vcpu['thread-id'], vcpu['cpu-index'])
+                      for vcpu in qmp.command('query-cpus-fast')])
+    finally:
+        qmp.close()
+
+    names = {}
+    for entry in os.listdir('/proc/%d/task' % pid):
+        try:
+            names[int(entry)] = open('/proc/%d/task/%s/comm' %
+                                     (pid, entry)).read().strip()
+        except IOError:
+            pass
+    # One vhost worker per queue pair, created in interface and queue order
+    vhost = {}
+    vhost_tids = sorted(vhost_threads(pid))
+    for intf in state['interfaces']:
+        if intf.get('vhost'):
+            vhost[intf['ifname']] = vhost_tids[:intf['queues']]
+            vhost_tids = vhost_tids[intf['queues']:]
+    for tids in vhost.values():
+        for tid in tids:
+            names[tid] = 'vhost-%d' % pid
+    msix = dict([(pcidev, vfio_msix_irqs(pcidev))
+                 for pcidev in state['pci_passthrough']])
+
+    kvm_dir = None
+    if perf:
+        perf_path = os.path.join(os.path.dirname(state['qmp']),
+                                 'vm%d.perf' % state['mgmt_idx'])
+        perf_proc = perf_kvm_record(pid, perf_path)
+    else:
+        kvm_dir = kvm_debugfs_dir(pid)
+        if kvm_dir is None:
+            print("No KVM statistics for pid %d in %s (is debugfs mounted?),"
+                  " try --perf" % (pid, KVM_DEBUGFS))
+            quit(1)
+
+    start = profile_sample(state, sorted(names), kvm_dir, msix, guest_user)
+    time.sleep(duration)
+    end = profile_sample(state, sorted(names), kvm_dir, msix, guest_user)
+    dt = end['time'] - start['time']
+
+    def cpu(tids):
+        return sum([end['cpu'].get(tid, 0) - start['cpu'].get(tid, 0)
+                    for tid in tids]) * 100.0 / dt
+
+    result = {'vm': state['mgmt_idx'], 'duration': dt,
+              'tuning': state.get('tuning'), 'nics': [], 'exits': [],
+              'threads': []}
+    packets = 0
+    for intf in state['interfaces']:
+        pkts = end['netdev'][intf['ifname']] - start['netdev'][intf['ifname']]
+        packets += pkts
+        nic = {'ifname': intf['ifname'], 'frontend': intf['frontend'],
+               'queues': intf['queues'], 'pkt_rate': pkts / dt,
+               'irq_rate': None, 'irq_per_pkt': None, 'msix_rate': None,
+               'vhost_cpu': cpu(vhost[intf['ifname']])
+                            if intf['ifname'] in vhost else None}
+        if start['guest_irqs'] is not None and end['guest_irqs'] is not None:
+            irqs = end['guest_irqs'][intf['mac']] - \
+                   start['guest_irqs'][intf['mac']]
+            nic['irq_rate'] = irqs / dt
+            nic['irq_per_pkt'] = irqs / float(pkts) if pkts else None
+        result['nics'].append(nic)
+    for pcidev in state['pci_passthrough']:
+        result['nics'].append({'ifname': pcidev, 'frontend': 'passthrough',
+                               'queues': len(msix[pcidev]), 'pkt_rate': None,
+                               'irq_rate': None, 'irq_per_pkt': None,
+                               'msix_rate': (end['msix'][pcidev] -
+                                             start['msix'][pcidev]) / dt,
+                               'vhost_cpu': None})
+
+    if perf:
+        for reason, count, share, avg in perf_kvm_report(perf_proc,
+                                                         perf_path):
+            result['exits'].append({'reason': reason, 'rate': count / dt,
+                                    'time_share': share, 'avg_us': avg})
+    else:
+        for name in sorted(end['kvm']):
+            result['exits'].append({'reason': name,
+                                    'rate': (end['kvm'][name] -
+                                             start['kvm'].get(name, 0)) / dt})
+    # The debugfs 'exits' counter is the total of all exits
+    result['exit_rate'] = sum([e['rate'] for e in result['exits']
+                               if perf or e['reason'] == 'exits'])
+    result['exits_per_pkt'] = result['exit_rate'] * dt / packets \
+                              if packets else None
+
+    for tid in sorted(names):
+        kind = 'vcpu %d' % vcpus[tid] if tid in vcpus else \
+               'vhost' if names[tid].startswith('vhost-') else 'qemu'
+        result['threads'].append({'tid': tid, 'name': names[tid],
+                                  'kind': kind, 'cpu': cpu([tid])})
+    return result
+
+
+def format_profile_value(value, fmt):
+    return '-' if value is None else fmt % value
+
+
+# Human readable tables for a vm_profile() result
+def format_profile(result):
+    lines = []
+    tuning = result['tuning'] or {}
+    lines.append("VM %d, %.1f s: %s" % (result['vm'], result['duration'],
+                 ', '.join(['%s %s' % (k.replace('_', '-'),
+                                       'on' if tuning[k] else 'off')
+                            for k in sorted(tuning)])))
+    lines.append('')
+    lines.append('%-14s %-15s %6s %10s %10s %8s %10s %7s' %
+                 ('NIC', 'frontend', 'queues', 'pkt/s', 'irq/s', 'irq/pkt',
+                  'msi-x/s', 'vhost%'))
+    for nic in result['nics']:
+        lines.append('%-14s %-15s %6d %10s %10s %8s %10s %7s' %
+                     (nic['ifname'], nic['frontend'], nic['queues'],
+                      format_profile_value(nic['pkt_rate'], '%.0f'),
+                      format_profile_value(nic['irq_rate'], '%.0f'),
+                      format_profile_value(nic['irq_per_pkt'], '%.3f'),
+                      format_profile_value(nic['msix_rate'], '%.0f'),
+                      format_profile_value(nic['vhost_cpu'], '%.1f')))
+    lines.append('')
+    lines.append('KVM exits: %.0f/s, %s per packet' %
+                 (result['exit_rate'],
+                  format_profile_value(result['exits_per_pkt'], '%.3f')))
+    for e in sorted(result['exits'], key = lambda e: -e['rate']):
+        if e['rate'] == 0 or e['reason'] == 'exits':
+            continue
+        line = '  %-28s %12.0f/s' % (e['reason'], e['rate'])
+        if 'avg_us' in e:
+            line += '  %5.1f%% time, %.2f us avg' % (e['time_share'],
+                                                     e['avg_us'])
+        lines.append(line)
+    lines.append('')
+    lines.append('%-8s %-16s %-8s %6s' % ('tid', 'thread', 'kind', 'cpu%'))
+    for t in result['threads']:
+        lines.append('%-8d %-16s %-8s %6.1f' % (t['tid'], t['name'],
+                                               t['kind'], t['cpu']))
+    return '\n'.join(lines)
+
 
-    out = [elem.strip() for elem in out]
-    vendor = None
-    devid = None
-    for elem in out:
-        columns = elem.split()
-        if len(columns) >= 3 and columns[0] == pcidev:
-            # Found
-            vendor, devid = columns[2].split(":")
+# Entry point for "qrun profile <vm>"
+def run_profile(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun profile',
+                        description = "Profile the KVM exits, interrupts and "
+                                      "thread CPU usage of a running VM")
+    parser.add_argument('vm', type = int,
+                        help = "Management index of the VM (-m)")
+    add_run_dir_argument(parser)
+    parser.add_argument('-d', '--duration', type = float, default = 10,
+                        help = "Profiling time, in seconds")
+    parser.add_argument('--perf', action='store_true',
+                        help = "Break down the KVM exits by reason with "
+                               "'perf kvm stat', rather than reading the "
+                               "KVM debugfs counters")
+    parser.add_argument('--guest-user', type = str, default = 'root',
+                        help = "User for SSH access to the guest, to read "
+                               "its interrupt counters")
+    parser.add_argument('--no-guest', action='store_true',
+                        help = "Don't log into the guest, host counters "
+                               "only")
+    parser.add_argument('--json', action='store_true',
+                        help = "Print the results in JSON format")
+    pargs = parser.parse_args(argv)
+
+    state = vm_state_load(pargs.run_dir, pargs.vm)
+    guest_user = None
+    if not pargs.no_guest and state['interfaces']:
+        if ssh_banner_ready(state['ssh_port']):
+            guest_user = pargs.guest_user
+        else:
+            print("Guest not reachable over SSH, skipping guest interrupts")
+    result = vm_profile(state, pargs.duration, pargs.perf, guest_user)
+    if pargs.json:
+        print(json.dumps(result, indent = 2))
+    else:
+        print(format_profile(result))
+
+
+# Kernel modules whose presence changes the preflight results
+PREFLIGHT_MODULES = ['kvm_intel', 'kvm_amd', 'vhost_net', 'tun', 'netmap',
+                     'vfio_pci', 'pci_stub']
+
+
+# Names (and aliases) listed by "qemu-system-x86_64 <@option> help"
+def qemu_help_names(qemu, option):
+    try:
+        out = subprocess.check_output([qemu, option, 'help'],
+                                      stderr = subprocess.STDOUT,
+                                      stdin = subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    names = []
+    for line in out.decode('utf-8', 'replace').splitlines():
+        if option == '-device':
+            # name "e1000", bus PCI, alias "e1000-82540em", desc "..."
+            names += re.findall(r'(?:name|alias) "([^"]+)"', line)
+        elif line and not line.endswith(':') and not line.startswith(' '):
+            names.append(line.split()[0])
+    return sorted(set(names))
+
+
+# Probe the host and QEMU for the features that qrun launches may need
+def preflight_probe(qemu):
+    caps = {}
+    caps['kvm'] = os.path.exists('/dev/kvm')
+    caps['nested'] = False
+    for module in ['kvm_intel', 'kvm_amd']:
+        try:
+            value = open('/sys/module/%s/parameters/nested' %
+                         module).read().strip().upper()
+        except IOError:
+            continue
+        caps['nested'] = caps['nested'] or value in ['Y', '1']
+    caps['tun'] = os.path.exists('/dev/net/tun')
+    caps['vhost_net'] = os.path.exists('/dev/vhost-net')
+    caps['netmap'] = os.path.exists('/dev/netmap')
+    try:
+        caps['iommu'] = len(os.listdir('/sys/kernel/iommu_groups')) > 0
+    except OSError:
+        caps['iommu'] = False
+    caps['hugetlbfs'] = {'2M': hugetlbfs_mount(2048),
+                         '1G': hugetlbfs_mount(1024 * 1024)}
+    caps['qemu'] = qemu
+    if qemu is not None:
+        caps['qemu_devices'] = qemu_help_names(qemu, '-device')
+        caps['qemu_netdevs'] = qemu_help_names(qemu, '-netdev')
+        caps['qemu_machines'] = qemu_help_names(qemu, '-machine')
+    return caps
+
+
+# Identifier of the current boot of the host, empty if unknown
+def host_boot_id():
+    try:
+        return open('/proc/sys/kernel/random/boot_id').read().strip()
+    except IOError:
+        return ''
+
+
+# Key of the preflight cache: the kernel boot, the QEMU binary, and the
+# host state that can change without a reboot (modules, hugetlbfs mounts)
+def preflight_key(qemu):
+    mounts = [line for line in open('/proc/mounts') if ' hugetlbfs ' in line]
+    modules = [m for m in PREFLIGHT_MODULES
+               if os.path.isdir('/sys/module/%s' % m)]
+    key = [host_boot_id(), os.uname()[2], qemu, modules, mounts]
+    if qemu is not None:
+        key.append(os.path.getmtime(qemu))
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+# Host capabilities, from the cache in @run_dir when still valid
+def preflight_caps(run_dir, refresh = False):
+    qemu = None
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, 'qemu-system-x86_64'), os.X_OK):
+            qemu = os.path.realpath(os.path.join(path, 'qemu-system-x86_64'))
             break
 
-    if vendor is None or devid is None:
-        print("Cannot find PCI device %s on the PCI subsystem" % pcidev)
-        quit(1)
+    key = preflight_key(qemu)
+    filename = os.path.join(run_dir, 'preflight.json')
+    if not refresh:
+        try:
+            cache = json.load(open(filename))
+            if cache['key'] == key:
+                return cache['caps']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    caps = preflight_probe(qemu)
+    # Concurrent launches may probe at the same time
+    tmp = '%s.%d' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'key': key, 'caps': caps}, f, indent = 2)
+    os.rename(tmp, filename)
+    return caps
+
+
+# Check the launch described by @args against the host capabilities
+# @caps. Returns the list of problems found.
+def preflight_check(args, num_backends, caps):
+    errors = []
+
+    if args.kvm and not caps['kvm']:
+        errors.append("KVM is not present, no /dev/kvm (load kvm_intel or "
+                      "kvm_amd, or use --no-kvm)")
+    elif args.kvm and not os.access('/dev/kvm', os.R_OK | os.W_OK):
+        errors.append("No permission to use /dev/kvm")
+    if args.nested_kvm and not caps['nested']:
+        errors.append("Nested KVM is not enabled")
+
+    backends = args.backend_type[:num_backends]
+    if 'tap' in backends and not caps['tun']:
+        errors.append("TAP backends need /dev/net/tun (load tun)")
+    if args.vhost_net and 'tap' in backends and not caps['vhost_net']:
+        errors.append("--vhost-net needs /dev/vhost-net (load vhost_net)")
+    netmap = [b for b in backends if b.startswith('netmap')]
+    if netmap and not caps['netmap']:
+        errors.append("netmap backends need /dev/netmap (load netmap)")
+    if args.hugepages and not args.hugepages_path and \
+            not caps['hugetlbfs'][args.hugepages]:
+        errors.append("No hugetlbfs mounted with %s pages" % args.hugepages)
+    if args.pci_passthrough_driver == 'vfio-pci' and \
+            (args.pci_passthrough or args.sriov_pf) and not caps['iommu']:
+        errors.append("VFIO passthrough needs the IOMMU (boot with "
+                      "intel_iommu=on or amd_iommu=on)")
+
+    if caps['qemu'] is None:
+        if not (args.dry_run or args.print_plan):
+            errors.append("qemu-system-x86_64 not found")
+        return errors
+
+    # Devices and backends only available in some QEMU builds
+    microvm = args.machine == 'microvm'
+    devices = [args.mgmt_nic] if args.mgmtnet and not microvm else []
+    for fe in args.frontend_type[:num_backends]:
+        devices.append('virtio-net-device' if microvm else fe)
+    if args.balloon:
+        devices.append('virtio-balloon-device' if microvm
+                       else 'virtio-balloon-pci')
+    if args.guest_agent:
+        devices.append('virtio-serial-device' if microvm
+                       else 'virtio-serial')
+    if args.pci_passthrough or args.sriov_pf:
+        devices.append('pci-assign' if args.pci_passthrough_driver ==
+                       'pci-stub' else 'vfio-pci')
+    for dev in devices:
+        if dev not in caps['qemu_devices']:
+            errors.append("Device %s is not supported by %s" %
+                          (dev, caps['qemu']))
+    for be in set(backends):
+        netdev = {'nat': 'user', 'socket-listen': 'socket',
+                  'socket-connect': 'socket'}.get(be, be)
+        if netdev.startswith('netmap'):
+            netdev = 'netmap'
+        if netdev not in caps['qemu_netdevs']:
+            errors.append("Backend %s is not supported by %s" %
+                          (netdev, caps['qemu']))
+    if args.machine and args.machine not in caps['qemu_machines']:
+        errors.append("Machine %s is not supported by %s" %
+                      (args.machine, caps['qemu']))
+
+    return errors
+
+
+# Entry point for "qrun preflight": show the host capabilities
+def run_preflight(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun preflight',
+                        description = "Probe and show the host capabilities "
+                                      "used to validate launches")
+    add_run_dir_argument(parser)
+    parser.add_argument('--refresh', action='store_true',
+                        help = "Probe again, ignoring the cache")
+    pargs = parser.parse_args(argv)
+
+    if not os.path.isdir(pargs.run_dir):
+        os.makedirs(pargs.run_dir)
+    caps = preflight_caps(pargs.run_dir, pargs.refresh)
+    for name in sorted(caps):
+        if isinstance(caps[name], list):
+            print("%-14s %d entries" % (name, len(caps[name])))
+        else:
+            print("%-14s %s" % (name, caps[name]))
 
-    if args.dry_run:
-        return
 
-    if args.pci_passthrough_driver == 'pci-stub':
-        cmdexe("sudo modprobe pci_stub")
-    else: # vfio
-        cmdexe("sudo modprobe vfio")
-        cmdexe("sudo modprobe vfio_pci")
-        cmdexe("sudo modprobe vfio_virqfd")
+# Format of the disk image @path, as detected by qemu-img
+def image_format(path):
+    out = subprocess.check_output(['qemu-img', 'info', '--output=json',
+                                   path])
+    return json.loads(out.decode('utf-8'))['format']
 
+
+# Create a qcow2 overlay @path backed by image @base
+def overlay_create(base, path):
+    base = os.path.abspath(base)
+    subprocess.check_output(['qemu-img', 'create', '-q', '-f', 'qcow2',
+                             '-b', base, '-F', image_format(base), path])
+
+
+# QEMU arguments for the VM disk. The disk is added as a bare image
+# (IDE, default cache mode) unless some disk option asks otherwise.
+def disk_args(args, disk_format):
+    legacy = args.machine != 'microvm' and disk_format is None and \
+             args.disk_interface == 'ide' and not args.disk_cache and \
+             not args.disk_aio and not args.disk_discard
+    if legacy:
+        return [args.image]
+
+    argv = ['-drive', 'file=%s,if=none,id=disk0' % args.image]
+    if disk_format:
+        argv[-1] += ',format=%s' % disk_format
+    if args.disk_cache:
+        argv[-1] += ',cache=%s' % args.disk_cache
+    if args.disk_aio:
+        argv[-1] += ',aio=%s' % args.disk_aio
+    if args.disk_discard:
+        argv[-1] += ',discard=unmap'
+
+    if args.machine == 'microvm':
+        argv += ['-device', 'virtio-blk-device,drive=disk0']
+    elif args.disk_interface == 'virtio-blk':
+        argv += ['-device', 'virtio-blk-pci,drive=disk0']
+    else:
+        argv += ['-device', 'ide-hd,drive=disk0']
+
+    if args.disk_iothread:
+        argv[-1] += ',iothread=iothread0'
+        argv += ['-object', 'iothread,id=iothread0']
+
+    return argv
+
+
+def pool_paths(pool_dir, mgmt_idx):
+    prefix = os.path.join(pool_dir, 'vm%d' % mgmt_idx)
+    return {'disk': prefix + '.qcow2', 'state': prefix + '.state',
+            'meta': prefix + '.json'}
+
+
+# Bring a pool VM to the ready state (SSH server up), then save its
+# state to the pool directory and shut it down. QEMU @pid is shut down
+# whatever happens, so that "qrun pool create" sees the VM exit (and
+# counts it as failed without a saved state).
+def pool_save(args, pid, timeout = 600):
+    paths = pool_paths(args.pool_save, args.mgmt_idx)
+    port = args.ssh_base_port + args.mgmt_idx
+    deadline = time.time() + timeout
+    status = 'not ready'
+    qmp = None
+    try:
+        while not ssh_banner_ready(port):
+            if time.time() > deadline:
+                return
+            time.sleep(0.5)
+
+        qmp = QMP(args.qmp_socket)
+        qmp.command('stop')
+        qmp.command('migrate', {'uri': 'exec:cat > %s' %
+                    shlex.quote(paths['state'])})
+        while True:
+            status = qmp.command('query-migrate').get('status')
+            if status in ['completed', 'failed', 'cancelled']:
+                break
+            time.sleep(0.1)
+    except QMPError as e:
+        status = str(e)
+    finally:
+        if status != 'completed':
+            print("Failed to save the state of VM %d (%s)" %
+                  (args.mgmt_idx, status))
+            if os.path.exists(paths['state']):
+                os.unlink(paths['state'])
+        try:
+            if qmp is None:
+                qmp = QMP(args.qmp_socket, timeout = 1)
+            qmp.command('quit')
+            qmp.close()
+        except QMPError:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    if status == 'completed':
+        print("VM %d saved to %s" % (args.mgmt_idx, paths['state']))
+
+
+# Resume a restored pool VM. Pool VMs are saved after a 'stop', and QEMU
+# keeps them paused once the incoming migration is loaded.
+def pool_resume(args, timeout = 600):
+    deadline = time.time() + timeout
+    try:
+        while True:
+            qmp = QMP(args.qmp_socket)
+            try:
+                status = qmp.command('query-status')['status']
+                if status == 'paused':
+                    qmp.command('cont')
+            finally:
+                qmp.close()
+            if status != 'inmigrate':
+                break
+            if time.time() > deadline:
+                print("VM %d state not restored" % args.mgmt_idx)
+                return
+            time.sleep(0.1)
+    except QMPError as e:
+        print("Failed to resume VM %d: %s" % (args.mgmt_idx, e))
+
+
+# Entry point for "qrun pool":
+#
+#   qrun pool create DIR --size K -- <qrun args>
+#       boot K VMs (mgmt index -m, -m + 1, ...) in parallel, wait for
+#       them to be reachable over SSH and save their state in DIR
+#
+#   qrun pool start DIR <mgmt-idx> [-- <more qrun args>]
+#       restore VM <mgmt-idx> from DIR, on a fresh disk overlay
+def run_pool(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun pool',
+                        description = "Manage a pool of pre-booted VMs")
+    parser.add_argument('action', choices = ['create', 'start'])
+    parser.add_argument('pool_dir', help = "Pool directory")
+    parser.add_argument('vm', type = int, nargs = '?',
+                        help = "Management index of the VM to start")
+    parser.add_argument('--size', type = int, default = 1,
+                        help = "Number of VMs in the pool")
+    parser.add_argument('-m', '--mgmt-idx', type = int, default = 1,
+                        help = "Management index of the first pool VM")
+    qrun_args = []
+    if '--' in argv:
+        qrun_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    pargs = parser.parse_args(argv)
+    qrun = [sys.executable, os.path.abspath(__file__)]
+
+    if pargs.action == 'create':
+        if not os.path.isdir(pargs.pool_dir):
+            os.makedirs(pargs.pool_dir)
+        children = []
+        for k in range(pargs.size):
+            mgmt_idx = pargs.mgmt_idx + k
+            vm_argv = qrun_args + ['-m', '%d' % mgmt_idx, '-o', 'none']
+            with open(pool_paths(pargs.pool_dir, mgmt_idx)['meta'], 'w') as f:
+                json.dump({'argv': vm_argv}, f)
+            children.append(subprocess.Popen(qrun + vm_argv +
+                            ['--pool-save', pargs.pool_dir],
+                            stdin = subprocess.DEVNULL))
+        failed = 0
+        for child in children:
+            if child.wait() != 0:
+                failed += 1
+        for k in range(pargs.size):
+            if not os.path.exists(pool_paths(pargs.pool_dir,
+                                             pargs.mgmt_idx + k)['state']):
+                failed += 1
+        if failed:
+            print("%d pool VMs failed" % failed)
+            quit(1)
+        return
+
+    if pargs.vm is None:
+        parser.error("the VM to start is required")
     try:
-        sysfs_write("/sys/bus/pci/devices/0000:%s/driver/unbind" % pcidev,
-                    "0000:%s" % pcidev)
-    except Exception as e:
-        print("Device %s not bound to any driver" % pcidev)
+        meta = json.load(open(pool_paths(pargs.pool_dir, pargs.vm)['meta']))
+    except IOError:
+        print("VM %d is not part of pool %s" % (pargs.vm, pargs.pool_dir))
+        quit(1)
+    argv = qrun + meta['argv'] + ['--pool-restore', pargs.pool_dir] + \
+            qrun_args
+    os.execv(argv[0], argv)
+
+
+# Remove from the qrun argument list @argv the options whose destination
+# is in @dests, together with their values
+def argv_strip(argv, dests):
+    actions = argparser._option_string_actions
+    out = []
+    i = 0
+    while i < len(argv):
+        opt = argv[i].split('=', 1)[0]
+        attached = '=' in argv[i]
+        if opt not in actions and not argv[i].startswith('--') and \
+                argv[i][:2] in actions:
+            # Short option with its value attached (e.g. -m10)
+            opt = argv[i][:2]
+            attached = True
+        action = actions.get(opt)
+        n = 1
+        if action is not None and not attached:
+            if action.nargs is None:
+                n = 2
+            elif action.nargs == '?' and i + 1 < len(argv) and \
+                    not argv[i + 1].startswith('-'):
+                n = 2
+        if action is None or action.dest not in dests:
+            out += argv[i:i + n]
+        i += n
+    return out
+
+
+# Options of the migration source which must not be replayed on the
+# destination: it gets its own indexes (on this host), QMP socket and
+# incoming migration, and runs on the disk image of the source
+MIGRATE_STRIP = ['mgmt_idx', 'auto_idx', 'idx', 'image', 'disk_format',
+                 'temp_mode', 'keep_overlay', 'own_image', 'pool_save',
+                 'pool_restore',
+                 'incoming', 'qmp_socket', 'vm_output_mode', 'measure_boot',
+                 'boot_report', 'plan_cache', 'print_plan', 'dry_run',
+                 'preflight_refresh']
+
+# Host resources named explicitly, which would collide on the same host
+MIGRATE_STRIP_LOCAL = ['console_file', 'hostfwd']
+
 
+# qrun arguments of the destination of a migration of the VM with state
+# @state, waiting for the migration to be started over @qmp_socket. The
+# destination runs on disk @image, which it deletes on exit if @own_image.
+def migrate_dest_argv(state, local, qmp_socket, image, own_image):
+    strip = MIGRATE_STRIP + (MIGRATE_STRIP_LOCAL if local else [])
+    argv = argv_strip(state['argv'], strip)
+    argv += ['-o', 'none', '--incoming', 'defer', '--qmp-socket', qmp_socket]
+    if image:
+        argv += ['-i', image]
+        if state['disk_format']:
+            argv += ['--disk-format', state['disk_format']]
+        if own_image:
+            argv += ['--own-image']
+    if local:
+        argv += ['--auto-idx']
+    else:
+        # Another host, keep the indexes (and so MACs and TAP names)
+        argv += ['-m', '%d' % state['mgmt_idx']]
+        for intf in state['interfaces']:
+            argv += ['-n', '%d' % intf['idx']]
+    return argv
+
+
+# Connect to the QMP socket of a migration destination which is still
+# starting up, as long as @alive() says it is
+def migrate_qmp_connect(path, alive, timeout = 60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return QMP(path, timeout = 1)
+        except (QMPError, OSError, ValueError):
+            if not alive() or time.time() > deadline:
+                return None
+            time.sleep(0.2)
+
+
+# Poll the outgoing migration on @qmp until it ends. With @postcopy, switch
+# to postcopy once the first pass over the guest RAM is done. A precopy
+# migration still running after @timeout seconds is cancelled.
+def migrate_wait(qmp, postcopy, timeout):
+    deadline = time.time() + timeout
+    switched = False
+    while True:
+        info = qmp.command('query-migrate')
+        status = info.get('status')
+        if status in ['completed', 'failed', 'cancelled']:
+            return info, switched
+        if postcopy and not switched and status == 'active' and \
+                info.get('ram', {}).get('dirty-sync-count', 0) > 1:
+            qmp.command('migrate-start-postcopy')
+            switched = True
+        if deadline and time.time() > deadline and status == 'active':
+            print("Migration timed out, cancelling it")
+            qmp.command('migrate_cancel')
+            deadline = None
+        time.sleep(0.1)
+
+
+# Shut down the source of a completed migration. VMs supervised by qrund
+# are stopped through the daemon, which would restart them otherwise.
+def migrate_handover(state):
+    if state.get('supervisor'):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(state['supervisor'])
+            sock.sendall((json.dumps({'cmd': 'stop',
+                                      'vm': state['mgmt_idx']}) +
+                          '\n').encode('ascii'))
+            resp = json.loads(sock.makefile('r').readline())
+            sock.close()
+            if resp['ok']:
+                return
+        except (OSError, ValueError):
+            pass
     try:
-        sysfs_write("/sys/bus/pci/drivers/%s/new_id" % newdr,
-                    "%s %s" % (vendor, devid))
-    except Exception as e:
-        print("Failed to bind vendor/devid %s:%s to driver %s" \
-                % (vendor, devid, newdr))
+        qmp = QMP(state['qmp'])
+        qmp.command('quit')
+        qmp.close()
+    except (QMPError, OSError):
+        pass
+
+
+# Entry point for "qrun migrate":
+#
+#   qrun migrate <vm> [--host [USER@]HOST] [options] [-- <more qrun args>]
+#
+# Live migrate VM <vm> to a new QEMU process, started by qrun with the
+# same arguments (and so the same backends and frontends) on this host or
+# on HOST over SSH. The disk image must be on storage shared by both.
+# Once the migration completes, the source VM is shut down.
+def run_migrate(argv):
+    parser = argparse.ArgumentParser(prog = 'qrun migrate',
+                        description = "Live migrate a running VM")
+    parser.add_argument('vm', type = int,
+                        help = "Management index of the VM to migrate")
+    add_run_dir_argument(parser)
+    parser.add_argument('--host', type = str,
+                        help = "Destination host ([user@]host, reached "
+                               "over SSH), by default this host")
+    parser.add_argument('--remote-qrun', type = str, default = 'qrun',
+                        help = "qrun command on the destination host")
+    parser.add_argument('--port', type = int, default = 4444,
+                        help = "TCP port of the migration stream")
+    parser.add_argument('--max-bandwidth', type = str,
+                        help = "Bandwidth cap of the migration, in bytes "
+                               "per second (e.g. 500M, 2G)")
+    parser.add_argument('--downtime-limit', type = int,
+                        help = "Maximum downtime in milliseconds")
+    parser.add_argument('--multifd', type = int, default = 0,
+                        metavar = 'CHANNELS',
+                        help = "Send the guest RAM over this many parallel "
+                               "connections")
+    parser.add_argument('--postcopy', action='store_true',
+                        help = "Switch to postcopy after the first pass "
+                               "over the guest RAM")
+    parser.add_argument('--timeout', type = int, default = 600,
+                        help = "Cancel a precopy migration that did not "
+                               "converge within this many seconds")
+    parser.add_argument('--report', type = str,
+                        help = "Append the migration results as JSON lines "
+                               "to this file")
+    qrun_args = []
+    if '--' in argv:
+        qrun_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    pargs = parser.parse_args(argv)
+
+    state = vm_state_load(pargs.run_dir, pargs.vm)
+    if not state.get('argv'):
+        print("The qrun arguments of VM %d are unknown, it cannot be "
+              "migrated" % pargs.vm)
+        quit(1)
+    if state['pci_passthrough']:
+        print("VMs with passthrough devices cannot be migrated")
+        quit(1)
+    local = pargs.host is None
+    if local and any([intf['backend'] == 'vhost-user'
+                      for intf in state['interfaces']]):
+        # Both QEMUs would need the same vhost-user sockets: a server
+        # socket cannot be bound twice, and a switch only serves one client
+        print("VMs with vhost-user interfaces can only be migrated to "
+              "another host")
+        quit(1)
+    if not local and state['temp_overlay']:
+        print("VM %d runs on a disk overlay deleted on exit, it can only be "
+              "migrated on this host" % pargs.vm)
+        quit(1)
+
+    # The source deletes its overlay on exit: the destination gets a hard
+    # link to it, which it owns
+    image = state['image']
+    link = None
+    if state['temp_overlay']:
+        link = os.path.join(os.path.dirname(image), 'qrun-migrated-%d-%d.qcow2'
+                            % (pargs.vm, os.getpid()))
+        os.link(image, link)
+        image = link
+
+    qmp_socket = os.path.join(state['run_dir'], 'migrate%d.qmp' % pargs.vm)
+    log = os.path.join(state['run_dir'], 'migrate%d.log' % pargs.vm)
+    dest_argv = migrate_dest_argv(state, local, qmp_socket, image,
+                                  link is not None) + qrun_args
+    forward = None
+    if local:
+        dest = subprocess.Popen([sys.executable, os.path.abspath(__file__)] +
+                                dest_argv, cwd = state['cwd'],
+                                stdin = subprocess.DEVNULL,
+                                stdout = open(log, 'w'),
+                                stderr = subprocess.STDOUT,
+                                start_new_session = True)
+        dest_qmp = qmp_socket
+        address = '127.0.0.1'
+        alive = lambda: dest.poll() is None
+    else:
+        ssh = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=5']
+        cmd = 'cd %s && setsid %s %s > %s 2>&1 < /dev/null &' % \
+              (shlex.quote(state['cwd']), pargs.remote_qrun,
+               ' '.join([shlex.quote(a) for a in dest_argv]),
+               shlex.quote(log))
+        subprocess.check_call(ssh + [pargs.host, cmd])
+        # The remote QMP socket is reached through an SSH forward
+        address = pargs.host.split('@')[-1]
+        dest_qmp = os.path.join(pargs.run_dir, 'migrate%d-%s.qmp' %
+                                (pargs.vm, address))
+        forward = subprocess.Popen(ssh + ['-N', '-o',
+                                   'ExitOnForwardFailure=yes', '-o',
+                                   'StreamLocalBindUnlink=yes', '-L',
+                                   '%s:%s' % (dest_qmp, qmp_socket),
+                                   pargs.host])
+        alive = lambda: forward.poll() is None
+
+    dst = migrate_qmp_connect(dest_qmp, alive)
+    if dst is None:
+        print("Migration destination did not start (see %s%s)" %
+              ('' if local else pargs.host + ':', log))
+        if forward:
+            forward.terminate()
+        if link and os.path.exists(link):
+            os.unlink(link)
         quit(1)
+    src = QMP(state['qmp'])
+
+    caps = []
+    if pargs.multifd:
+        caps.append({'capability': 'multifd', 'state': True})
+    if pargs.postcopy:
+        caps.append({'capability': 'postcopy-ram', 'state': True})
+    params = {}
+    if pargs.max_bandwidth:
+        params['max-bandwidth'] = parse_size(pargs.max_bandwidth)
+    if pargs.downtime_limit is not None:
+        params['downtime-limit'] = pargs.downtime_limit
+    if pargs.multifd:
+        params['multifd-channels'] = pargs.multifd
+
+    t0 = time.time()
+    switched = False
+    try:
+        for qmp in [src, dst]:
+            if caps:
+                qmp.command('migrate-set-capabilities',
+                            {'capabilities': caps})
+        if pargs.multifd:
+            dst.command('migrate-set-parameters',
+                        {'multifd-channels': pargs.multifd})
+        if params:
+            src.command('migrate-set-parameters', params)
+        dst.command('migrate-incoming', {'uri': 'tcp:0:%d' % pargs.port})
+        src.command('migrate', {'uri': 'tcp:%s:%d' % (address, pargs.port)})
+        info, switched = migrate_wait(src, pargs.postcopy, pargs.timeout)
+    except QMPError as e:
+        print("Migration of VM %d failed: %s" % (pargs.vm, e))
+        info = {'status': 'failed'}
+    elapsed = time.time() - t0
+    src.close()
 
-    print("PCI device with vendor %s and devid %s unbound from "\
-            "its driver and bound to %s" % (vendor, devid, newdr))
+    ram = info.get('ram', {})
+    result = {'vm': pargs.vm, 'host': pargs.host or 'localhost',
+              'status': info['status'], 'time': elapsed,
+              'total_time_ms': info.get('total-time'),
+              'setup_time_ms': info.get('setup-time'),
+              'downtime_ms': info.get('downtime'),
+              'bytes': ram.get('transferred'),
+              'dirty_syncs': ram.get('dirty-sync-count'),
+              'multifd': pargs.multifd, 'postcopy': switched,
+              'max_bandwidth': params.get('max-bandwidth'),
+              'downtime_limit_ms': pargs.downtime_limit}
+
+    if info['status'] == 'completed':
+        dest_idx = state['mgmt_idx']
+        if local:
+            for s in vm_states_running(state['run_dir']):
+                if s['qrun_pid'] == dest.pid:
+                    dest_idx = s['mgmt_idx']
+        result['dest_vm'] = dest_idx
+        dst.close()
+        migrate_handover(state)
+        print("VM %d migrated to %s as VM %d in %.3f s" %
+              (pargs.vm, result['host'], dest_idx, elapsed))
+        print("  total %s ms, downtime %s ms, setup %s ms%s" %
+              (result['total_time_ms'], result['downtime_ms'],
+               result['setup_time_ms'], ', postcopy' if switched else ''))
+        if result['bytes'] is not None:
+            print("  %.1f MiB sent, %s dirty syncs" %
+                  (result['bytes'] / 1048576.0, result['dirty_syncs']))
+    else:
+        if switched:
+            print("Migration of VM %d failed in postcopy, the VM cannot "
+                  "resume on either host" % pargs.vm)
+        else:
+            print("Migration of VM %d %s, the source keeps running" %
+                  (pargs.vm, info['status']))
+        try:
+            dst.command('quit')
+        except QMPError:
+            pass
+        dst.close()
+
+    if forward:
+        forward.terminate()
+        forward.wait()
+    if pargs.report:
+        with open(pargs.report, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    if info['status'] != 'completed':
+        quit(1)
 
 
 description = "Python script to launch QEMU VMs"
@@ -138,19 +3422,82 @@ argparser.add_argument('-p', '--ssh-base-port',
                        type = int, default = 20000)
 argparser.add_argument('-i', '--image',
                        help = "Path to the VM disk image", type = str)
+argparser.add_argument('--disk-format', type = str,
+                       help = "Format of the disk image (e.g. qcow2, raw), "
+                              "rather than letting QEMU probe it")
 argparser.add_argument('--num-cpus',
                        help = "Number of CPUs for the VM",
                        type = int, default = 2)
 argparser.add_argument('--memory',
                        help = "Size of the VM memory (e.g. 256M, 2G)",
                        type = str, default = '2G')
+argparser.add_argument('--hugepages', nargs='?', const='2M',
+                       choices = ['2M', '1G'],
+                       help = "Back the VM memory with hugepages of the "
+                              "given size (default 2M)")
+argparser.add_argument('--hugepages-path', type = str,
+                       help = "Path of the hugetlbfs mount to be used with "
+                              "--hugepages (autodetected by default)")
+argparser.add_argument('--no-prealloc', dest='prealloc', action='store_false',
+                       help = "Don't preallocate hugepages at VM startup")
+argparser.add_argument('--host-nodes', type = str,
+                       help = "Bind the VM hugepages to these host NUMA "
+                              "nodes (e.g. 0, 0-1). By default, the nodes "
+                              "of the --pin cores are used")
+argparser.add_argument('--guest-numa', action='store_true',
+                       help = "With --pin and --hugepages, expose a guest "
+                              "NUMA node for each host node used by the "
+                              "vCPUs, with memory bound to that node")
 argparser.add_argument('--temp', dest = 'temp_mode',
                        action='store_true',
-                       help = "Enable non persistent disk mode")
+                       help = "Enable non persistent disk mode, using a "
+                              "qcow2 overlay on top of the image")
+argparser.add_argument('--overlay-dir', type = str, default = '/var/tmp',
+                       help = "Directory for the --temp disk overlays "
+                              "(e.g. on tmpfs or NVMe)")
+argparser.add_argument('--keep-overlay', action='store_true',
+                       help = "Don't delete the --temp overlay on exit, and "
+                              "reuse it if it already exists (for the same "
+                              "VM index and image)")
+argparser.add_argument('--own-image', action='store_true',
+                       help = "Delete the --image on exit, as a --temp "
+                              "overlay (used by 'qrun migrate' to hand the "
+                              "overlay of the source VM over)")
+argparser.add_argument('--disk-interface', choices = ['ide', 'virtio-blk'],
+                       default = 'ide', help = "Disk controller")
+argparser.add_argument('--disk-cache', type = str,
+                       choices = ['none', 'writeback', 'writethrough',
+                                  'directsync', 'unsafe'],
+                       help = "Disk cache mode")
+argparser.add_argument('--disk-aio', type = str,
+                       choices = ['threads', 'native', 'io_uring'],
+                       help = "Disk asynchronous I/O engine")
+argparser.add_argument('--disk-discard', action='store_true',
+                       help = "Pass discard requests to the disk image")
+argparser.add_argument('--disk-iothread', action='store_true',
+                       help = "Run the disk emulation in its own iothread "
+                              "(requires --disk-interface virtio-blk)")
+argparser.add_argument('--pool-save', type = str, metavar = 'DIR',
+                       help = "Once the VM is reachable over SSH, save its "
+                              "state and disk to DIR and exit (used by "
+                              "'qrun pool create')")
+argparser.add_argument('--pool-restore', type = str, metavar = 'DIR',
+                       help = "Restore the VM from the state saved in DIR, "
+                              "on a fresh disk overlay (used by "
+                              "'qrun pool start')")
+argparser.add_argument('--incoming', type = str, metavar = 'URI',
+                       help = "Wait for the VM state to be migrated in from "
+                              "URI (e.g. tcp:0:4444, or defer to start the "
+                              "migration over QMP) rather than booting "
+                              "(used by 'qrun migrate')")
 argparser.add_argument('-m', '--mgmt-idx', type = int,
                        help = "An index for the VM, to be used for the "
                               "management port",
                        default = 1)
+argparser.add_argument('--auto-idx', action='store_true',
+                       help = "Automatically pick free management and data "
+                              "indexes (and so ports, TAP names, sockets "
+                              "and MACs), safe with concurrent launches")
 argparser.add_argument('--mgmt-nic',
                        help = "NIC model to use for mgmt", type = str,
                        choices = ['e1000', 'e1000e', 'virtio-net-pci', 'pcnet',
@@ -183,8 +3530,39 @@ argparser.add_argument('--unix-socket', action='append',
 argparser.add_argument('--no-unix-server', dest='unix_server', action='store_false',
                        help = "When vhost-user is used, act as an unix socket"\
                                 " client rather than an unix socket server")
+argparser.add_argument('--vhost-user-dir', type = str, default = '/var/run',
+                       help = "Directory of the vhost-user sockets not given "
+                              "with --unix-socket")
+argparser.add_argument('--vhost-user-reconnect', type = int, metavar = 'SECS',
+                       help = "With --no-unix-server, reconnect to the "
+                              "vhost-user switch every SECS seconds after a "
+                              "disconnection (e.g. a switch restart)")
+argparser.add_argument('--vhost-user-wait', type = float, default = 30,
+                       metavar = 'SECS',
+                       help = "How long to wait for the vhost-user sockets "
+                              "to be created")
+argparser.add_argument('--vhost-user-switch', type = str, metavar = 'CMD',
+                       help = "Run a vhost-user switch together with the VM. "
+                              "CMD can use %%(sockets)s (all the sockets) and "
+                              "%%(s0)s, %%(s1)s, ... (the sockets of the "
+                              "vhost-user interfaces); 'testpmd' runs DPDK "
+                              "testpmd forwarding between the interfaces "
+                              "(or back to a single interface). Without "
+                              "--no-unix-server, QEMU creates each socket "
+                              "once the previous one is connected, so CMD "
+                              "must retry connecting")
+argparser.add_argument('--vhost-user-switch-cpus', type = str,
+                       metavar = 'CPULIST',
+                       help = "Host CPUs to pin the vhost-user switch to")
 argparser.add_argument('--no-bridging', dest='bridging', action='store_false',
                        help = "When TAP backend is used, don't attach it to a bridge")
+argparser.add_argument('--no-bridge-create', dest='bridge_create',
+                       action='store_false',
+                       help = "When TAP backend is used, assume that the "
+                              "bridges already exist (used by --topology)")
+argparser.add_argument('--topology', type = str,
+                       help = "Launch all the VMs, bridges and switches "
+                              "described in a YAML/JSON topology file")
 argparser.add_argument('--no-kvm', dest='kvm', action='store_false',
                        help = "Disable KVM, falling back to userspace emulation")
 argparser.add_argument('--vhost-net', action='store_true',
@@ -196,6 +3574,37 @@ argparser.add_argument('--no-ioeventfd', dest='ioeventfd', action='store_false',
 argparser.add_argument('--num-queues',
                        help = "Number of queues in a TAP device",
                        type = int, default = 1)
+argparser.add_argument('--queues', action='append',
+                       help = "Number of queues for a data interface "
+                              "(defaults to --num-queues)",
+                       type = int, default = [])
+argparser.add_argument('--queue-affinity', action='store_true',
+                       help = "With --pin, align the TAP XPS/RPS masks, "
+                              "vhost workers and passthrough IRQs of each "
+                              "queue pair to the core of a vCPU")
+argparser.add_argument('--guest-agent', action='store_true',
+                       help = "Add a QEMU guest agent channel")
+argparser.add_argument('--guest-set-channels', action='store_true',
+                       help = "Enable all the queues of multiqueue "
+                              "virtio-net interfaces in the guest, using "
+                              "the guest agent (implies --guest-agent)")
+argparser.add_argument('--pin', action='store_true',
+                       help = "Pin vCPU, I/O and vhost threads to host cores")
+argparser.add_argument('--pin-cpus', type = str,
+                       help = "Host cores to be used with --pin (e.g. 2-5,8). "
+                              "The first --num-cpus cores are used for "
+                              "vCPUs, the other ones for I/O and vhost "
+                              "threads. By default cores are picked on the "
+                              "NUMA node of the first --pci-passthrough "
+                              "device")
+argparser.add_argument('--qmp-socket', type = str,
+                       help = "Path of the QMP unix socket (by default "
+                              "vm<mgmt-idx>.qmp in --run-dir)")
+argparser.add_argument('--stats', action='store_true',
+                       help = "Periodically export the VM runtime statistics")
+argparser.add_argument('--balloon', action='store_true',
+                       help = "Add a virtio balloon device")
+add_stats_arguments(argparser)
 argparser.add_argument('--interrupt-mitigation', action='store_true',
                        help = "Enable NIC interrupt mitigation")
 argparser.add_argument('--passthrough', action='store_true',
@@ -210,6 +3619,24 @@ argparser.add_argument('--kernel',
 argparser.add_argument('--initramfs',
                        help = "Path to the initramfs image to be used by the "
                               "VM (direct boot mode)", type = str)
+argparser.add_argument('--kernel-cmdline', type = str, default = 'console=ttyS0',
+                       help = "Kernel command line (direct boot mode)")
+argparser.add_argument('--machine', type = str,
+                       choices = ['pc', 'q35', 'microvm'],
+                       help = "QEMU machine type")
+argparser.add_argument('--fast-boot', action='store_true',
+                       help = "Boot with a minimal device set: no VGA, no "
+                              "default devices, microvm machine (with "
+                              "--kernel) or q35")
+argparser.add_argument('--measure-boot', action='store_true',
+                       help = "Measure the time to the first serial output, "
+                              "to the console marker and to SSH reachability")
+argparser.add_argument('--boot-marker', type = str, default = 'login:',
+                       help = "Serial console string marking the end of "
+                              "boot, for --measure-boot")
+argparser.add_argument('--boot-report', type = str,
+                       help = "Append --measure-boot results as JSON lines "
+                              "to this file")
 argparser.add_argument('--console-tcp', action='store_true',
                        help = "Redirect serial console to TCP port. "
                               "Deprecated, use --console-file instead")
@@ -231,121 +3658,309 @@ argparser.add_argument('--plus',
                        help = "Additional command line arguments (can be anything)",
                        type = str)
 argparser.add_argument('--pci-passthrough', action = 'append', default = [],
-                       help = "Passthrough an host PCI device xx:yy.z to the VM")
+                       help = "Passthrough an host PCI device [dddd:]bb:dd.f "
+                              "to the VM")
+argparser.add_argument('--sriov-pf', action = 'append', default = [],
+                       help = "SR-IOV physical function (PCI address or "
+                              "interface name) to allocate VFs from. Can be "
+                              "repeated, PFs on the NUMA node of --pin-cpus "
+                              "are preferred")
+argparser.add_argument('--sriov-vfs', type = int, default = 1,
+                       help = "Number of VFs to allocate from --sriov-pf "
+                              "and pass through to the VM")
+argparser.add_argument('--sriov-vlan', type = int,
+                       help = "VLAN to be set on the allocated VFs")
 argparser.add_argument('--pci-passthrough-driver',
                        choices = ['pci-stub', 'vfio-pci'], default = 'vfio-pci',
                        help = "Driver to use for PCI passthrough")
+argparser.add_argument('--preflight-refresh', action='store_true',
+                       help = "Probe the host and QEMU capabilities again, "
+                              "rather than using the cached results")
+argparser.add_argument('--plan-cache', action='store_true',
+                       help = "Cache the launch plan (QEMU arguments and host "
+                              "actions) in the run directory, and reuse it "
+                              "for the same arguments without validating "
+                              "them or probing the host again")
+argparser.add_argument('--print-plan', action='store_true',
+                       help = "Only show the launch plan, in JSON format")
 
-args = argparser.parse_args()
 
-# Validate append parameters
-for i in range(len(args.idx)):
-    try:
-        idx = int(args.idx[i])
-        args.idx[i] = idx
-    except ValueError:
-        argparser.error('argument --idx: invalid int value %s' % idx)
+# A VM launch, as built by launch_prepare(): the QEMU argv, the host-side
+# actions (disk overlays, bridges and TAPs, devices to pass through) and
+# the arguments as resolved at preparation time (indexes, sockets, disk
+# image). A plan can be stored as JSON and run again without validating
+# the arguments or probing the host.
+class LaunchPlan:
+    def __init__(self, args, argv, num_backends):
+        self.args = args
+        self.argv = argv
+        self.num_backends = num_backends
+        self.bridges = []
+        self.net_setup = []
+        self.net_teardown = []
+        self.pci_passthrough = []
+        # Each entry is [base image, overlay path, keep existing overlay]
+        self.overlays = []
+        self.temp_overlay = None
+        self.pool_overlay = None
+        self.pin_vcpu_cpus = None
+        self.pin_emu_cpus = None
+        self.vhost_user_sockets = []
+        self.vhost_user_switch = None
+
+    def cmdline(self):
+        return ' '.join([shlex.quote(arg) for arg in self.argv])
+
+    def to_json(self):
+        plan = dict(self.__dict__)
+        plan['args'] = vars(self.args)
+        return plan
+
+    @classmethod
+    def from_json(cls, obj):
+        plan = cls(argparse.Namespace(**obj['args']), obj['argv'],
+                   obj['num_backends'])
+        for key in obj:
+            if key != 'args':
+                setattr(plan, key, obj[key])
+        return plan
+
+
+# Path of the cached plan for the qrun arguments @argv. Besides the
+# arguments, the key covers the qrun script and the current boot of the
+# host, whose probing results a plan embeds.
+def plan_cache_path(run_dir, argv):
+    key = json.dumps([argv, os.path.getmtime(os.path.realpath(__file__)),
+                      host_boot_id()])
+    return os.path.join(run_dir, 'plans',
+                        hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
 
-for i in range(len(args.br_idx)):
+def plan_load(filename):
     try:
-        idx = int(args.br_idx[i])
-        args.br_idx[i] = idx
-    except ValueError:
-        argparser.error('argument --br-idx: invalid int value %s' % idx)
+        return LaunchPlan.from_json(json.load(open(filename)))
+    except (IOError, ValueError, KeyError):
+        return None
 
-# Complete append lists
-num_backends = max(len(args.idx), len(args.br_idx), len(args.backend_type),
-                   len(args.frontend_type))
 
-if num_backends > 0 and len(args.idx) == 0:
-    args.idx.append(args.mgmt_idx)
-while len(args.idx) < num_backends:
-    args.idx.append(args.idx[-1] + 1)
+def plan_store(filename, plan):
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(plan.to_json(), f, indent = 2)
+    os.rename(filename + '.tmp', filename)
 
-if num_backends > 0 and len(args.br_idx) == 0:
-    args.br_idx.append(1)
-while len(args.br_idx) < num_backends:
-    args.br_idx.append(args.br_idx[-1])
 
-while len(args.backend_type) < num_backends:
-    args.backend_type.append('tap')
+# Validate the arguments of a VM launch, allocate its resources and
+# build its LaunchPlan
+def launch_prepare(args):
+    user_idx = len(args.idx) > 0
+    num_backends = complete_append_lists(argparser, args)
 
-while len(args.frontend_type) < num_backends:
-    args.frontend_type.append('e1000')
+    pin_vcpu_cpus = None
+    pin_emu_cpus = None
 
-while len(args.netmap) < num_backends:
-    args.netmap.append('vale')
+    if not os.path.isdir(args.run_dir):
+        os.makedirs(args.run_dir)
 
-if args.kvm and not os.path.isdir('/sys/module/kvm_intel') and not os.path.isdir('/sys/module/kvm_amd'):
-        print('KVM is not present')
+    if args.fast_boot and args.machine is None:
+        args.machine = 'microvm' if args.kernel else 'q35'
+
+    # Fail early, before anything is set up on the host
+    errors = preflight_check(args, num_backends,
+                             preflight_caps(args.run_dir,
+                                            args.preflight_refresh))
+    for error in errors:
+        print(error)
+    if errors:
         quit(1)
 
-if args.nested_kvm:
-    try:
-        en_kvm = open('/sys/module/kvm_intel/parameters/nested', 'r').read().strip().upper()
-    except:
-        en_kvm = 'N'
+    # Plans which are only shown don't reserve indexes or VFs
+    reserve = not (args.dry_run or args.print_plan)
+    args.launch_token = launch_token()
+    if args.auto_idx:
+        args.mgmt_idx, auto_idx = idx_allocate(args, num_backends,
+                                               reserve = reserve)
+        # Explicit data indexes are kept, e.g. to connect socket backends
+        if not user_idx:
+            args.idx = auto_idx
+        print("Using mgmt index %d, data indexes %s" %
+              (args.mgmt_idx, ' '.join(['%d' % idx for idx in args.idx])))
 
-    try:
-        en_amd = open('/sys/module/kvm_amd/parameters/nested', 'r').read().strip().upper()
-    except:
-        en_amd = 'N'
+    for i in range(len(args.pci_passthrough)):
+        # PCI device must be in the form [dddd:]bb:dd.f, with exadecimal digits
+        pcidev = pci_normalize(args.pci_passthrough[i])
+        if pcidev is None:
+            print("Invalid PCI device identifier '%s'" % args.pci_passthrough[i])
+            quit(1)
+        args.pci_passthrough[i] = pcidev
+
+    if args.sriov_pf:
+        args.pci_passthrough += sriov_allocate(args, reserve = reserve)
+
+    if args.pin:
+        pin_vcpu_cpus, pin_emu_cpus = pin_plan(args)
+
+    if args.qmp_socket is None:
+        args.qmp_socket = os.path.join(args.run_dir, 'vm%d.qmp' % args.mgmt_idx)
+
+    if args.queue_affinity and not args.pin:
+        print("--queue-affinity requires --pin")
+        quit(1)
+
+    if args.guest_set_channels:
+        args.guest_agent = True
+
+    if args.guest_agent:
+        args.guest_agent_socket = os.path.join(args.run_dir,
+                                               'vm%d.qga' % args.mgmt_idx)
+
+    if args.install_from_iso:
+        args.temp_mode = False
+        args.vm_output_mode = 'window'
+
+    if args.disk_iothread and args.disk_interface != 'virtio-blk' and \
+            args.machine != 'microvm':
+        print("--disk-iothread requires --disk-interface virtio-blk")
+        quit(1)
+
+    if args.disk_aio == 'native' and args.disk_cache not in ['none', 'directsync']:
+        print("--disk-aio native requires --disk-cache none or directsync")
+        quit(1)
 
-    if en_kvm != 'Y' and en_amd != 'Y':
-        print('Nested KVM is not enabled')
+    if args.incoming and args.pool_restore:
+        print("--incoming cannot be used with --pool-restore")
         quit(1)
 
-#print(args)
+    # Pool VMs run on disk overlays rather than in snapshot mode
+    disk_format = args.disk_format
+    temp_overlay = None
+    pool_overlay = None
+    pool_incoming = None
+    overlays = []
+    if args.pool_save or args.pool_restore:
+        if not args.image:
+            print("Pool VMs require a disk image")
+            quit(1)
+        args.temp_mode = False
+        if args.pool_save:
+            if not args.mgmtnet:
+                print("--pool-save requires the management network")
+                quit(1)
+            pool_overlay = pool_paths(args.pool_save, args.mgmt_idx)['disk']
+            overlays.append([args.image, pool_overlay, False])
+        else:
+            paths = pool_paths(args.pool_restore, args.mgmt_idx)
+            if not os.path.exists(paths['state']):
+                print("No saved state for VM %d in %s" % (args.mgmt_idx,
+                                                          args.pool_restore))
+                quit(1)
+            pool_overlay = os.path.join(args.run_dir,
+                                        'vm%d.qcow2' % args.mgmt_idx)
+            overlays.append([paths['disk'], pool_overlay, False])
+            pool_incoming = 'exec:cat %s' % shlex.quote(paths['state'])
+        args.image = pool_overlay
+        disk_format = 'qcow2'
+
+    # Non persistent disk mode runs on a qcow2 overlay
+    if args.temp_mode and args.image:
+        # Named after the base image too, so that --keep-overlay never
+        # reuses an overlay of another image
+        base = hashlib.sha1(os.path.abspath(args.image).encode('utf-8'))
+        temp_overlay = os.path.join(args.overlay_dir, 'qrun-vm%d-%s.qcow2' %
+                                    (args.mgmt_idx, base.hexdigest()[:8]))
+        overlays.append([args.image, temp_overlay, args.keep_overlay])
+        args.image = temp_overlay
+        disk_format = 'qcow2'
+    elif args.own_image and args.image:
+        temp_overlay = args.image
+    args.disk_format = disk_format
 
-if args.install_from_iso:
-    args.temp = False
-    args.vm_output_mode = 'window'
+    if args.machine == 'microvm':
+        if not args.kernel:
+            print("microvm machine requires --kernel")
+            quit(1)
+        # No PCI bus, only virtio-mmio devices (the mgmt interface is
+        # always virtio-net-device)
+        for fe in args.frontend_type[:num_backends]:
+            if fe != 'virtio-net-pci':
+                print("microvm machine only supports virtio-net-pci frontends "
+                      "(as virtio-net-device)")
+                quit(1)
+        if args.pci_passthrough or args.sriov_pf:
+            print("microvm machine has no PCI bus for passthrough devices")
+            quit(1)
+
+    if args.measure_boot:
+        if args.console_tcp:
+            print("--measure-boot needs the serial console on a file")
+            quit(1)
+        if not args.console_file:
+            args.console_file = os.path.join(args.run_dir,
+                                             'vm%d.console' % args.mgmt_idx)
+
+    argv = ['qemu-system-x86_64']
+    if args.machine:
+        argv += ['-M', args.machine]
+    if args.fast_boot:
+        argv += ['-nodefaults', '-no-user-config']
 
-try:
-    cmdline = 'qemu-system-x86_64'
     if args.image:
-        cmdline += ' %s' % args.image
+        argv += disk_args(args, disk_format)
 
     if args.kernel:
-        cmdline += ' -kernel %s' % args.kernel
-        cmdline += ' -append "console=ttyS0"'
+        argv += ['-kernel', args.kernel]
+        argv += ['-append', args.kernel_cmdline]
     if args.initramfs:
-        cmdline += ' -initrd %s' % args.initramfs
+        argv += ['-initrd', args.initramfs]
 
     if args.kvm:
-        cmdline += ' -enable-kvm'
-    cmdline += ' -smp %d' % args.num_cpus
-    cmdline += ' -m %s' % args.memory
+        argv += ['-enable-kvm']
+    argv += ['-smp', '%d' % args.num_cpus]
+    argv += ['-m', args.memory]
 
     if args.console_tcp or args.console_file:
         args.vm_output_mode = 'none'
 
-    cmdline += ' -vga std'
+    if args.fast_boot:
+        # No default serial port with -nodefaults
+        if args.vm_output_mode == 'stdio':
+            argv += ['-serial', 'stdio']
+        args.vm_output_mode = 'none'
+    else:
+        argv += ['-vga', 'std']
     if args.vm_output_mode == 'stdio':
-        cmdline += ' -nographic'
+        argv += ['-nographic']
     elif args.vm_output_mode == 'none':
-        cmdline += ' -display none'
+        argv += ['-display', 'none']
     elif args.vm_output_mode == 'window':
         pass
 
-    if args.temp_mode:
-        cmdline += ' -snapshot'
+    if args.temp_mode and not args.image:
+        argv += ['-snapshot']
+
+    if pool_incoming:
+        argv += ['-incoming', pool_incoming]
+    elif args.incoming:
+        argv += ['-incoming', args.incoming]
 
     if args.install_from_iso:
-        cmdline += ' -cdrom %s' % args.install_from_iso
-        cmdline += ' -boot order=dc'
+        argv += ['-cdrom', args.install_from_iso]
+        argv += ['-boot', 'order=dc']
 
     if args.console_file:
-        cmdline += ' -serial file:%s' % (args.console_file)
+        argv += ['-serial', 'file:%s' % args.console_file]
     elif args.console_tcp:
-        cmdline += ' -serial tcp:127.0.0.1:%d,server,nowait' %\
-                     (args.console_base_port + args.mgmt_idx)
+        argv += ['-serial', 'tcp:127.0.0.1:%d,server,nowait' %
+                 (args.console_base_port + args.mgmt_idx)]
 
     if args.mgmtnet:
         # Add management interface with netuser backend
-        cmdline += ' -device %s,netdev=mgmt,mac=00:AA:BB:CC:%02x:99' % (args.mgmt_nic, args.mgmt_idx)
-        cmdline += ' -netdev user,id=mgmt,hostfwd=tcp::%d-:22' \
-                    % (args.ssh_base_port + args.mgmt_idx)
+        mgmt_nic = 'virtio-net-device' if args.machine == 'microvm' \
+                    else args.mgmt_nic
+        argv += ['-device', '%s,netdev=mgmt,mac=00:AA:BB:CC:%02x:99' % (mgmt_nic, args.mgmt_idx)]
+        argv += ['-netdev', 'user,id=mgmt,hostfwd=tcp::%d-:22'
+                 % (args.ssh_base_port + args.mgmt_idx)]
         for hf in args.hostfwd:
             m = re.match(r'(\d+):(\d+)', hf)
             if m == None:
@@ -353,165 +3968,421 @@ try:
             else:
                 hostport = int(m.group(1))
                 guestport = int(m.group(2))
-                cmdline += ',hostfwd=tcp::%d-:%d' % (hostport, guestport)
+                argv[-1] += ',hostfwd=tcp::%d-:%d' % (hostport, guestport)
 
-    # When vhost-user is used, add memory backend file object
-    for i in range(num_backends):
-        if args.backend_type[i] == 'vhost-user':
-            cmdline += ' -numa node,memdev=mem0'\
-                       ' -object memory-backend-file,id=mem0,size=%s,'\
-                       'mem-path=/dev/hugepages,share=on' % args.memory
-            break
+    if args.vhost_user_reconnect and args.unix_server:
+        print("--vhost-user-reconnect requires --no-unix-server")
+        quit(1)
+
+    if args.vhost_user_switch == 'testpmd' and not args.unix_server:
+        print("The testpmd switch connects as a vhost-user client, so it "
+              "cannot be used with --no-unix-server")
+        quit(1)
+
+    # Add memory backend objects for hugepages and vhost-user
+    argv += memory_backend_args(args, num_backends,
+                                pin_vcpu_cpus if args.pin else None)
 
+    vhost_user_sockets = []
+    vhost_user_queues = 1
     for i in range(num_backends):
         backend_ifname = get_backend_ifname(args, i)
         backend_name = get_backend_name(args, i)
 
         vars_dict = {'idx': args.idx[i], 'vmid': args.mgmt_idx,
                      'fe': args.frontend_type[i]}
+        virtio_mmio = args.machine == 'microvm'
+        if virtio_mmio:
+            vars_dict['fe'] = 'virtio-net-device'
 
         # Add data interface
-        cmdline += ' -device %(fe)s,netdev=data%(idx)d,mac=00:AA:BB:CC:%(vmid)02x:%(idx)02x'\
-                        % vars_dict
-        if args.frontend_type[i] in ['virtio-net-pci', 'e1000-paravirt']:
-            cmdline += ',ioeventfd=%s' % ('on' if args.ioeventfd else 'off',)
+        argv += ['-device', '%(fe)s,netdev=data%(idx)d,mac=00:AA:BB:CC:%(vmid)02x:%(idx)02x'
+                 % vars_dict]
+        if args.frontend_type[i] in ['virtio-net-pci', 'e1000-paravirt'] \
+                and not virtio_mmio:
+            argv[-1] += ',ioeventfd=%s' % ('on' if args.ioeventfd else 'off',)
 
         if args.frontend_type[i] in ['e1000', 'e1000-paravirt']:
-            cmdline += ',mitigation=%s' % ('on' if args.interrupt_mitigation else 'off',)
+            argv[-1] += ',mitigation=%s' % ('on' if args.interrupt_mitigation else 'off',)
 
         if args.frontend_type[i] in ['virtio-net-pci']:
-            cmdline += ',mrg_rxbuf=%s' % ('on' if args.mrg_rx_bufs else 'off',)
-            if args.num_queues > 1:
-                cmdline += ',mq=on,vectors=%d' % (2 * args.num_queues + 1)
+            argv[-1] += ',mrg_rxbuf=%s' % ('on' if args.mrg_rx_bufs else 'off',)
+            if args.queues[i] > 1:
+                argv[-1] += ',mq=on'
+                if not virtio_mmio:
+                    # One vector per RX/TX queue, plus the control queue
+                    # and the configuration interrupt
+                    argv[-1] += ',vectors=%d' % (2 * args.queues[i] + 2)
                 # enable multi-queuing into the guest using
-                #         ethtool -L eth0 combined args.num_queues
+                #         ethtool -L eth0 combined args.queues[i]
+                # or use --guest-set-channels
 
         # Add data backend
         if args.backend_type[i] == 'nat':
-            cmdline += ' -netdev user,net=10.79.%(idx)d.0/24,id=data%(idx)d' % vars_dict
+            argv += ['-netdev', 'user,net=10.79.%(idx)d.0/24,id=data%(idx)d' % vars_dict]
 
         elif args.backend_type[i] in ['socket-listen', 'socket-connect']:
             cs = args.backend_type[i][7:]
-            cmdline += ' -netdev socket,%s=127.0.0.1:%d,id=data%d' % (cs, 4000 + args.idx[i], args.idx[i])
+            argv += ['-netdev', 'socket,%s=127.0.0.1:%d,id=data%d' % (cs, 4000 + args.idx[i], args.idx[i])]
 
         elif args.backend_type[i] == 'vhost-user':
             if args.frontend_type[i] != 'virtio-net-pci':
                 print("vhost-user backend requires virtio-net-pci frontend")
                 quit(1)
 
-            if len(args.unix_socket) > 0:
-                vars_dict['upath'] = args.unix_socket[0]
-                args.unix_socket.pop(0)
-            else:
-                vars_dict['upath'] = '/var/run/vm%(vmid)d-%(idx)d.socket' % vars_dict
+            vars_dict['upath'] = vhost_user_socket(args, i)
+            vhost_user_sockets.append(vars_dict['upath'])
+            vhost_user_queues = max(vhost_user_queues, args.queues[i])
 
-            cmdline += ' -netdev type=vhost-user,id=data%(idx)d,chardev=char%(idx)s'\
-                       ' -chardev socket,id=char%(idx)d,path=%(upath)s'\
-                        % vars_dict
+            argv += ['-netdev', 'type=vhost-user,id=data%(idx)d,chardev=char%(idx)s' % vars_dict]
+            if args.queues[i] > 1:
+                argv[-1] += ',queues=%d' % args.queues[i]
+            argv += ['-chardev', 'socket,id=char%(idx)d,path=%(upath)s' % vars_dict]
 
             if args.unix_server:
-                cmdline += ",server"
+                argv[-1] += ",server"
+            elif args.vhost_user_reconnect:
+                # Survive restarts of the vhost-user switch
+                argv[-1] += ',reconnect=%d' % args.vhost_user_reconnect
 
         else:
-            cmdline += ' -netdev %s,ifname=%s,id=data%d' % (backend_name, backend_ifname, args.idx[i])
+            argv += ['-netdev', '%s,ifname=%s,id=data%d' % (backend_name, backend_ifname, args.idx[i])]
 
         if args.frontend_type[i] in ['virtio-net-pci'] and args.backend_type[i] in ['tap']:
-            cmdline += ',vhost=%s' % ('on' if args.vhost_net else 'off',)
+            argv[-1] += ',vhost=%s' % ('on' if args.vhost_net else 'off',)
 
         if args.backend_type[i] in ['tap']:
-            cmdline += ',script=no,downscript=no'
-            if args.num_queues > 1:
-                cmdline += ',queues=%d' % (args.num_queues)
+            argv[-1] += ',script=no,downscript=no'
+            if args.queues[i] > 1:
+                argv[-1] += ',queues=%d' % (args.queues[i])
 
         if args.backend_type[i] in ['netmap', 'netmap-pipe-master', 'netmap-pipe-slave']:
             if args.passthrough or args.frontend_type[i] in ['ptnet-pci']:
-                cmdline += ',passthrough=on'
+                argv[-1] += ',passthrough=on'
                 kloop_tx = 'off' if args.kloop_direct_tx else 'on'
                 kloop_rx = 'off' if args.kloop_direct_rx else 'on'
-                cmdline += ',klooptx=%s,klooprx=%s' % (kloop_tx, kloop_rx)
+                argv[-1] += ',klooptx=%s,klooprx=%s' % (kloop_tx, kloop_rx)
 
         del vars_dict
 
     if args.device:
-        cmdline += ' -device %s' % (args.device)
+        argv += ['-device'] + shlex.split(args.device)
 
     for pcidev in args.pci_passthrough:
-        # PCI device must be in the form xx:yy.z, with exadecimal digits
-        m = re.match(r'^[0-9a-fA-F]{2}:[0-9a-fA-F]{2}\.[0-9a-fA-F]$', pcidev)
-        if m is None:
-            print("Invalid PCI device identifier '%s'" % pcidev)
-            quit(1)
+        # Check that the device exists
+        pci_ids(pcidev)
 
-        # Get the name of current driver
-        pci_driver = pci_driver_name(args, pcidev)
-
-        # Unbind device from current driver
-        pci_driver_rebind(args, pcidev)
         if args.pci_passthrough_driver == 'pci-stub':
             pci_pt_qemu_dev = 'pci-assign'
         else:
             pci_pt_qemu_dev = args.pci_passthrough_driver
-        cmdline += ' -device %s,host=%s' % (pci_pt_qemu_dev, pcidev)
+        argv += ['-device', '%s,host=%s' % (pci_pt_qemu_dev, pcidev)]
 
     if args.nested_kvm:
-        cmdline += ' -cpu host'
+        argv += ['-cpu', 'host']
+
+    argv += ['-qmp', 'unix:%s,server,nowait' % args.qmp_socket]
+
+    if args.balloon:
+        argv += ['-device', 'virtio-balloon-device' if
+                 args.machine == 'microvm' else 'virtio-balloon-pci']
+
+    if args.guest_agent:
+        argv += ['-chardev', 'socket,path=%s,server,nowait,id=qga0' %
+                 args.guest_agent_socket,
+                 '-device', 'virtio-serial-device' if
+                 args.machine == 'microvm' else 'virtio-serial',
+                 '-device', 'virtserialport,chardev=qga0,'
+                 'name=org.qemu.guest_agent.0']
 
     if args.plus:
-        cmdline += ' %s' % args.plus
+        argv += shlex.split(args.plus)
 
-    if args.dry_run:
-        print(cmdline)
-        quit(1)
+    plan = LaunchPlan(args, argv, num_backends)
+    plan.bridges = tap_bridges(args, num_backends)
+    plan.net_setup = tap_setup_cmds(args, num_backends)
+    plan.net_teardown = tap_teardown_cmds(args, num_backends)
+    plan.pci_passthrough = list(args.pci_passthrough)
+    plan.overlays = overlays
+    plan.temp_overlay = temp_overlay
+    plan.pool_overlay = pool_overlay
+    plan.pin_vcpu_cpus = pin_vcpu_cpus
+    plan.pin_emu_cpus = pin_emu_cpus
+    plan.vhost_user_sockets = vhost_user_sockets
+    if args.vhost_user_switch and vhost_user_sockets:
+        plan.vhost_user_switch = vhost_user_switch_argv(args,
+                                            vhost_user_sockets,
+                                            vhost_user_queues)
 
-    for i in range(num_backends):
-        backend_ifname = get_backend_ifname(args, i)
+    return plan
 
-        if args.backend_type[i] == 'tap':
-            if args.bridging:
-                try:
-                    cmdexe('sudo brctl addbr br%02d' % args.br_idx[i], False)
-                    cmdexe('sudo ip link set br%02d up' % args.br_idx[i])
-                except:
-                    # They bridge may already exist
-                    pass
-
-            cmd = 'sudo ip tuntap add mode tap name %s' % backend_ifname
-            if args.num_queues > 1:
-                cmd += ' multi_queue'
-            try:
-                cmdexe(cmd)
-            except:
-                print("Failed to create the TAP device '%s'" % backend_ifname)
-                quit(1)
-            cmdexe('sudo ip link set %s up' % backend_ifname)
 
-            if args.bridging:
-                cmdexe('sudo brctl addif br%02d %s' % (args.br_idx[i], backend_ifname))
+# Set up the host side of a launch: disk overlays, passthrough devices,
+# TAPs and bridges
+def host_setup(plan):
+    args = plan.args
+
+    # On failure only what was done here is undone: TAPs that already
+    # existed (e.g. those of another VM with the same indexes) are kept
+    taps = [get_backend_ifname(args, i) for i in range(plan.num_backends)
+            if args.backend_type[i] == 'tap']
+    taps_before = [ifname for ifname in taps
+                   if os.path.exists('/sys/class/net/%s' % ifname)]
+    overlays = []
+    pci = False
+
+    try:
+        for base, path, keep in plan.overlays:
+            if not (keep and os.path.exists(path)):
+                overlay_create(base, path)
+                overlays.append(path)
+
+        if args.measure_boot and os.path.exists(args.console_file):
+            os.unlink(args.console_file)
+
+        if plan.pci_passthrough:
+            if args.pci_passthrough_driver == 'vfio-pci':
+                pci_check_iommu_groups(plan.pci_passthrough)
+            pci_passthrough_setup(args, plan.pci_passthrough)
+            pci = True
+
+        try:
+            bridges_setup(plan.bridges)
+            ip_batch(plan.net_setup)
+        except subprocess.CalledProcessError:
+            print("Failed to set up the host network (TAP devices and "
+                  "bridges)")
+            quit(1)
+
+    except BaseException:
+        cmds = ['link del %s' % ifname for ifname in taps
+                if ifname not in taps_before and
+                os.path.exists('/sys/class/net/%s' % ifname)]
+        try:
+            ip_batch(cmds, force = True)
+        except subprocess.CalledProcessError:
+            pass
+        if pci:
+            pci_passthrough_restore(args, plan.pci_passthrough)
+        for path in overlays:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+
+
+# Undo host_setup() and release the resources of a launch
+def host_teardown(plan):
+    args = plan.args
+
+    # The overlay of a restored pool VM is not reused
+    if args.pool_restore and os.path.exists(plan.pool_overlay):
+        os.unlink(plan.pool_overlay)
+
+    if plan.temp_overlay and not args.keep_overlay and \
+            os.path.exists(plan.temp_overlay):
+        os.unlink(plan.temp_overlay)
+
+    for filename in [vm_state_path(args.run_dir, args.mgmt_idx),
+                     args.qmp_socket]:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    # ip -force still fails if any command did, which must not keep the
+    # devices and reservations below from being given back
+    try:
+        ip_batch(plan.net_teardown, force = True)
+    except subprocess.CalledProcessError:
+        print("Failed to remove some host network devices of VM %d" %
+              args.mgmt_idx)
+
+    pci_passthrough_restore(args, plan.pci_passthrough)
+
+    launch_release(args)
+
+
+# Give back the indexes and VFs reserved by launch_prepare()
+def launch_release(args):
+    if args.sriov_pf:
+        sriov_release(args)
+
+    if args.auto_idx:
+        idx_release(args)
+
+
+# Post-launch work for a QEMU process @pid started at time @t0 (pinning,
+# queue affinity, guest agent, boot measure, pool save). Returns the state
+# of the running VM.
+def launch_started(plan, pid, t0):
+    args = plan.args
+    num_backends = plan.num_backends
+    if args.pin:
+        try:
+            pin_vm_threads(args, pid, plan.pin_vcpu_cpus, plan.pin_emu_cpus)
+        except Exception as e:
+            print("Failed to pin VM threads: %s" % e)
+    if args.queue_affinity:
+        try:
+            queue_affinity(args, pid, num_backends, plan.pin_vcpu_cpus)
+        except Exception as e:
+            print("Failed to set queue affinity: %s" % e)
+    if args.guest_set_channels:
+        qga_thread = threading.Thread(target = guest_set_channels,
+                                      args = (args, num_backends))
+        qga_thread.daemon = True
+        qga_thread.start()
+    if args.measure_boot:
+        boot_thread = threading.Thread(target = measure_boot,
+                                       args = (args, t0))
+        boot_thread.daemon = True
+        boot_thread.start()
+    if args.pool_save:
+        pool_thread = threading.Thread(target = pool_save,
+                                       args = (args, pid))
+        pool_thread.daemon = True
+        pool_thread.start()
+    if args.pool_restore:
+        pool_thread = threading.Thread(target = pool_resume, args = (args,))
+        pool_thread.daemon = True
+        pool_thread.start()
+    return vm_state_save(args, num_backends, pid)
 
+
+# Run QEMU for a prepared launch and wait for it to exit
+def launch_run(plan):
+    args = plan.args
+    qemu = None
+    switch = None
+    stats_stop = threading.Event()
     try:
-        subprocess.check_call(cmdline, shell=True)
+        if not args.unix_server and plan.vhost_user_sockets:
+            # QEMU connects to the sockets of the switch
+            if plan.vhost_user_switch:
+                switch = vhost_user_switch_start(plan)
+            if not vhost_user_wait_sockets(plan.vhost_user_sockets,
+                                           args.vhost_user_wait):
+                raise ValueError("vhost-user sockets %s are not ready" %
+                                 ' '.join(plan.vhost_user_sockets))
+
+        if args.unix_server and plan.vhost_user_switch:
+            # Don't mistake stale sockets for the ones QEMU creates
+            for path in plan.vhost_user_sockets:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        qemu_t0 = time.time()
+        qemu = subprocess.Popen(plan.argv)
+
+        if args.unix_server and plan.vhost_user_switch:
+            # The switch connects to the sockets created by QEMU. QEMU
+            # creates them one at a time, each once a client connected
+            # to the previous one, so only the first one can be waited
+            # for: the switch must retry on the others (as testpmd does
+            # in client mode).
+            if not vhost_user_wait_sockets(plan.vhost_user_sockets[:1],
+                                           args.vhost_user_wait):
+                raise ValueError("QEMU did not create the vhost-user "
+                                 "socket %s" % plan.vhost_user_sockets[0])
+            switch = vhost_user_switch_start(plan)
+
+        vm_state = launch_started(plan, qemu.pid, qemu_t0)
+        if args.stats:
+            stats_thread = threading.Thread(target = vm_stats_loop,
+                                args = (vm_state, args.stats_interval,
+                                        args.stats_format, args.stats_output,
+                                        stats_stop))
+            stats_thread.daemon = True
+            stats_thread.start()
+        if qemu.wait() != 0:
+            raise subprocess.CalledProcessError(qemu.returncode, plan.argv)
+    except ValueError as e:
+        print(e)
+        if qemu is not None and qemu.poll() is None:
+            qemu.terminate()
+            qemu.wait()
     except:
         print('QEMU terminated with an exception')
+        if qemu is not None and qemu.poll() is None:
+            qemu.terminate()
+            qemu.wait()
 
-    for i in range(num_backends):
-        backend_ifname = get_backend_ifname(args, i)
+    stats_stop.set()
+    if switch is not None:
+        vhost_user_switch_stop(switch)
 
-        if args.backend_type[i] == 'tap':
-            cmdexe('sudo ip link set %s down' % backend_ifname)
 
-            if args.bridging:
-                cmdexe('sudo brctl delif br%02d %s' % (args.br_idx[i], backend_ifname))
+# Entry point of the qrun command, @argv excludes the program name
+def main(argv):
+    if len(argv) > 0 and argv[0] == 'bench':
+        run_bench(argv[1:])
+        quit(0)
 
-            cmd = 'sudo ip tuntap del mode tap name %s' % backend_ifname
-            if args.num_queues > 1:
-                cmd += ' multi_queue'
-            cmdexe(cmd)
+    if len(argv) > 0 and argv[0] == 'stats':
+        run_stats(argv[1:])
+        quit(0)
 
-    for pcidev in args.pci_passthrough:
-        pci_driver_rebind(args, pcidev, pci_driver)
+    if len(argv) > 0 and argv[0] == 'top':
+        run_top(argv[1:])
+        quit(0)
+
+    if len(argv) > 0 and argv[0] == 'preflight':
+        run_preflight(argv[1:])
+        quit(0)
+
+    if len(argv) > 0 and argv[0] == 'pci-restore':
+        # Give back the PCI devices left behind by crashed qrun processes
+        pci_restore_stale(argv[1] if len(argv) > 1 else '/tmp/qrun')
+        quit(0)
+
+    if len(argv) > 0 and argv[0] == 'pool':
+        run_pool(argv[1:])
+        quit(0)
+
+    if len(argv) > 0 and argv[0] == 'migrate':
+        run_migrate(argv[1:])
+        quit(0)
+
+    if len(argv) > 0 and argv[0] == 'profile':
+        run_profile(argv[1:])
+        quit(0)
+
+    args = argparser.parse_args(argv)
+    args.qrun_argv = argv
+
+    if args.topology:
+        run_topology(args.topology)
+        quit(0)
+
+    plan = None
+    if args.plan_cache:
+        if args.auto_idx or args.sriov_pf:
+            print("--plan-cache cannot be used with --auto-idx or --sriov-pf")
+            quit(1)
+        cache = plan_cache_path(args.run_dir, argv)
+        plan = plan_load(cache)
+
+    try:
+        if plan is None:
+            plan = launch_prepare(args)
+            if args.plan_cache:
+                plan_store(cache, plan)
+
+        if args.print_plan:
+            print(json.dumps(plan.to_json(), indent = 2))
+            quit(0)
+
+        if args.dry_run:
+            print(plan.cmdline())
+            for cmd in bridges_setup_cmds(plan.bridges) + plan.net_setup:
+                print("# ip -batch: %s" % cmd)
+            quit(1)
+
+        host_setup(plan)
+        launch_run(plan)
+        host_teardown(plan)
+
+    except subprocess.CalledProcessError as e:
+        print(e.output)
 
-except subprocess.CalledProcessError as e:
-    print(e.output)
 
-#except Exception as e:
-#    print(e)
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+# qrund: supervisor daemon for qrun VMs
+#
+# The daemon listens on a local unix socket (<run-dir>/qrund.sock) and
+# speaks JSON lines: each request is an object with a 'cmd' key, each
+# response an object with an 'ok' key (and 'error' when 'ok' is false).
+#
+#   {"cmd": "start", "argv": ["-i", "vm.qcow2", "-b", "tap"], "restart": true}
+#   {"cmd": "stop", "vm": 10}
+#   {"cmd": "list"}
+#   {"cmd": "stats", "vm": 10}
+#
+# VMs are launched with the same arguments as qrun, and the QEMU processes
+# are direct children of the daemon. Each child's QMP socket is used
+# asynchronously, and the host resources of a VM (TAPs, passthrough
+# devices, overlays, indexes) are released when its QEMU process exits.
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import qrun
+
+
+# Asynchronous client for the QEMU Machine Protocol. As with qrun.QMP,
+# replies are awaited for @reply_timeout seconds only, since a client
+# queued behind another one never gets the greeting.
+class AsyncQMP:
+    def __init__(self, reader, writer, reply_timeout):
+        self.reader = reader
+        self.writer = writer
+        self.reply_timeout = reply_timeout
+
+    @classmethod
+    async def connect(cls, path, timeout = 10, reply_timeout = 10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise qrun.QMPError("Cannot connect to QMP socket %s"
+                                        % path)
+                await asyncio.sleep(0.05)
+        qmp = cls(reader, writer, reply_timeout)
+        try:
+            await qmp.recv()
+            await qmp.command('qmp_capabilities')
+        except qrun.QMPError:
+            qmp.close()
+            raise
+        return qmp
+
+    async def recv(self):
+        try:
+            line = await asyncio.wait_for(self.reader.readline(),
+                                          self.reply_timeout)
+        except asyncio.TimeoutError:
+            raise qrun.QMPError("QMP reply timed out")
+        if not line:
+            raise qrun.QMPError("QMP connection closed")
+        return json.loads(line)
+
+    async def command(self, name, arguments = None):
+        req = {'execute': name}
+        if arguments:
+            req['arguments'] = arguments
+        self.writer.write((json.dumps(req) + '\n').encode('ascii'))
+        await self.writer.drain()
+        while True:
+            resp = await self.recv()
+            if 'return' in resp:
+                return resp['return']
+            if 'error' in resp:
+                raise qrun.QMPError("%s: %s" % (name, resp['error']['desc']))
+            # Asynchronous event, skip it
+
+    def close(self):
+        self.writer.close()
+
+
+# A VM supervised by the daemon
+class Child:
+    def __init__(self, argv, plan, restart):
+        self.argv = argv
+        self.args = plan.args
+        self.plan = plan
+        self.restart = restart
+        self.proc = None
+        self.state = None
+        self.status = 'starting'
+        self.restarts = 0
+        self.returncode = None
+        self.started = None
+        self.stopping = False
+
+    def describe(self):
+        return {'vm': self.args.mgmt_idx, 'status': self.status,
+                'pid': self.proc.pid if self.proc else None,
+                'returncode': self.returncode, 'restarts': self.restarts,
+                'restart': self.restart, 'argv': self.argv,
+                'ssh_port': self.args.ssh_base_port + self.args.mgmt_idx,
+                'qmp': self.args.qmp_socket,
+                'uptime': time.time() - self.started if self.started
+                          and self.status == 'running' else None}
+
+
+class Daemon:
+    # A child that crashes sooner than this after (re)start is restarted
+    # with an exponential backoff
+    RESTART_MIN_UPTIME = 60
+    RESTART_MAX_DELAY = 30
+
+    def __init__(self, run_dir, stop_timeout):
+        self.run_dir = run_dir
+        self.stop_timeout = stop_timeout
+        self.children = {}
+        # Indexes of the VMs being started
+        self.claimed = set()
+        self.path = None
+        # Host network changes are serialized, since VMs that share a
+        # bridge would race to create it
+        self.host_lock = asyncio.Lock()
+
+    # Run a blocking qrun function in the default executor. qrun reports
+    # fatal errors with quit(), which is turned into an exception here.
+    async def blocking(self, func, *fargs):
+        def wrapper():
+            try:
+                return func(*fargs)
+            except SystemExit:
+                raise RuntimeError("%s failed (see the qrund log)"
+                                   % func.__name__)
+        return await asyncio.get_running_loop().run_in_executor(None, wrapper)
+
+    async def start(self, argv, restart):
+        try:
+            args = qrun.argparser.parse_args(argv + ['--run-dir',
+                                                     self.run_dir])
+        except SystemExit:
+            raise RuntimeError("Invalid qrun arguments: %s" % ' '.join(argv))
+        args.qrun_argv = argv + ['--run-dir', self.run_dir]
+        # Lets 'qrun migrate' stop the source VM without a restart
+        args.supervisor = self.path
+        if args.topology or args.dry_run or args.pool_save or \
+                args.vhost_user_switch:
+            raise RuntimeError("--topology, --dry-run, --pool-save and "
+                               "--vhost-user-switch are not supported by "
+                               "qrund")
+        # Consoles cannot be attached to the daemon
+        if args.vm_output_mode != 'none':
+            args.vm_output_mode = 'none'
+        # The index is claimed before the first await, so that concurrent
+        # starts of the same VM cannot both go through
+        claimed = None
+        if not args.auto_idx:
+            self.claim(args.mgmt_idx)
+            claimed = args.mgmt_idx
+
+        try:
+            plan = await self.blocking(qrun.launch_prepare, args)
+            if args.auto_idx:
+                # Explicit indexes of other VMs are not in the registry
+                self.claim(args.mgmt_idx)
+                claimed = args.mgmt_idx
+            # host_setup() undoes its own work if it fails
+            async with self.host_lock:
+                await self.blocking(qrun.host_setup, plan)
+        except Exception:
+            # The daemon stays alive, so what the launch reserved would
+            # never be reclaimed
+            if getattr(args, 'launch_token', None):
+                await self.blocking(qrun.launch_release, args)
+            self.claimed.discard(claimed)
+            raise
+
+        child = Child(argv, plan, restart)
+        self.children[args.mgmt_idx] = child
+        self.claimed.discard(claimed)
+        try:
+            await self.spawn(child)
+        except Exception:
+            del self.children[args.mgmt_idx]
+            await self.blocking(qrun.host_teardown, plan)
+            raise
+        asyncio.get_running_loop().create_task(self.supervise(child))
+        return child
+
+    def claim(self, mgmt_idx):
+        if mgmt_idx in self.children or mgmt_idx in self.claimed:
+            raise RuntimeError("VM %d is already supervised" % mgmt_idx)
+        self.claimed.add(mgmt_idx)
+
+    async def spawn(self, child):
+        log = open(os.path.join(self.run_dir, 'vm%d.log' %
+                                child.args.mgmt_idx), 'a')
+        child.started = time.time()
+        child.proc = await asyncio.create_subprocess_exec(*child.plan.argv,
+                            stdin = asyncio.subprocess.DEVNULL,
+                            stdout = log, stderr = log)
+        log.close()
+        child.status = 'running'
+        child.returncode = None
+        child.state = await self.blocking(qrun.launch_started, child.plan,
+                                          child.proc.pid, child.started)
+
+    # Wait for the QEMU process of @child to exit, then restart it (if
+    # asked to) or release its host resources
+    async def supervise(self, child):
+        delay = 1
+        while True:
+            child.returncode = await child.proc.wait()
+            if child.stopping or not child.restart:
+                break
+            if time.time() - child.started > self.RESTART_MIN_UPTIME:
+                delay = 1
+            print("VM %d exited with code %d, restarting in %d seconds" %
+                  (child.args.mgmt_idx, child.returncode, delay))
+            child.status = 'restarting'
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RESTART_MAX_DELAY)
+            if child.stopping:
+                break
+            child.restarts += 1
+            try:
+                await self.spawn(child)
+            except Exception as e:
+                print("Failed to restart VM %d: %s" % (child.args.mgmt_idx, e))
+                break
+
+        child.status = 'stopped' if child.stopping else 'exited'
+        async with self.host_lock:
+            try:
+                await self.blocking(qrun.host_teardown, child.plan)
+            except Exception as e:
+                print("Failed to clean up VM %d: %s" % (child.args.mgmt_idx,
+                                                        e))
+        del self.children[child.args.mgmt_idx]
+
+    # Ask QEMU to quit over QMP, then fall back to signals
+    async def stop(self, child):
+        child.stopping = True
+        if child.proc is None or child.proc.returncode is not None:
+            return
+        try:
+            qmp = await AsyncQMP.connect(child.args.qmp_socket, timeout = 1,
+                                         reply_timeout = self.stop_timeout)
+            try:
+                await qmp.command('quit')
+            finally:
+                qmp.close()
+        except (qrun.QMPError, OSError):
+            pass
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                await asyncio.wait_for(asyncio.shield(child.proc.wait()),
+                                       self.stop_timeout)
+                return
+            except asyncio.TimeoutError:
+                if child.proc.returncode is None:
+                    child.proc.send_signal(sig)
+        await child.proc.wait()
+
+    async def stats(self, child):
+        if child.status != 'running':
+            raise RuntimeError("VM %d is %s" % (child.args.mgmt_idx,
+                                                child.status))
+        qmp = await AsyncQMP.connect(child.args.qmp_socket, timeout = 1)
+        try:
+            status = await qmp.command('query-status')
+            vcpus = await qmp.command('query-cpus-fast')
+            blocks = await qmp.command('query-blockstats')
+        finally:
+            qmp.close()
+
+        pid = child.proc.pid
+        result = {'vm': child.args.mgmt_idx, 'status': status['status'],
+                  'vcpus': [], 'blocks': [], 'interfaces': []}
+        for vcpu in vcpus:
+            try:
+                secs = qrun.thread_cpu_seconds(pid, vcpu['thread-id'])
+            except IOError:
+                continue
+            result['vcpus'].append({'vcpu': vcpu['cpu-index'],
+                                    'thread': vcpu['thread-id'],
+                                    'cpu_seconds': secs})
+        for blk in blocks:
+            result['blocks'].append({'device': blk.get('device') or
+                                               blk.get('qdev', ''),
+                                     'stats': blk['stats']})
+        for intf in child.state['interfaces']:
+            result['interfaces'].append({'ifname': intf['ifname'],
+                    'counters': qrun.netdev_counters(intf['ifname'])})
+        return result
+
+    def lookup(self, req):
+        try:
+            return self.children[int(req['vm'])]
+        except (KeyError, ValueError, TypeError):
+            raise RuntimeError("Unknown VM %s" % req.get('vm'))
+
+    async def dispatch(self, req):
+        cmd = req.get('cmd')
+        if cmd == 'start':
+            child = await self.start([str(x) for x in req.get('argv', [])],
+                                     bool(req.get('restart', False)))
+            return {'vm': child.describe()}
+        if cmd == 'stop':
+            child = self.lookup(req)
+            await self.stop(child)
+            return {'vm': child.describe()}
+        if cmd == 'list':
+            return {'vms': [self.children[idx].describe()
+                            for idx in sorted(self.children)]}
+        if cmd == 'stats':
+            return {'stats': await self.stats(self.lookup(req))}
+        raise RuntimeError("Unknown command '%s'" % cmd)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    resp = await self.dispatch(json.loads(line))
+                    resp['ok'] = True
+                except Exception as e:
+                    resp = {'ok': False, 'error': str(e)}
+                writer.write((json.dumps(resp) + '\n').encode('ascii'))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        self.path = path
+        if not os.path.isdir(self.run_dir):
+            os.makedirs(self.run_dir)
+        # Devices left bound by crashed qrun or qrund processes
+        await self.blocking(qrun.pci_restore_stale, self.run_dir)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        server = await asyncio.start_unix_server(self.handle, path)
+        os.chmod(path, 0o600)
+        print("qrund listening on %s" % path)
+
+        done = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, done.set)
+        await done.wait()
+
+        server.close()
+        await server.wait_closed()
+        children = list(self.children.values())
+        await asyncio.gather(*[self.stop(child) for child in children],
+                             return_exceptions = True)
+        # Wait for the supervisors to release the host resources
+        while self.children:
+            await asyncio.sleep(0.1)
+        os.unlink(path)
+
+
+# Send a request to the daemon and return its response
+def request(path, req):
+    async def roundtrip():
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write((json.dumps(req) + '\n').encode('ascii'))
+        await writer.drain()
+        line = await reader.readline()
+        writer.close()
+        return json.loads(line)
+
+    try:
+        resp = asyncio.run(roundtrip())
+    except (OSError, ValueError) as e:
+        print("Cannot talk to qrund on %s: %s" % (path, e))
+        quit(1)
+    if not resp['ok']:
+        print(resp['error'])
+        quit(1)
+    return resp
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = 'qrund',
+                        description = "Supervise many qrun VMs behind a "
+                                      "local unix-socket API")
+    parser.add_argument('--run-dir', type = str, default = '/tmp/qrun',
+                        help = "Directory for the daemon socket, the VM "
+                               "state files and the QEMU logs")
+    parser.add_argument('--socket', type = str,
+                        help = "Path of the daemon socket (default: "
+                               "<run-dir>/qrund.sock)")
+    sub = parser.add_subparsers(dest = 'cmd')
+    serve = sub.add_parser('serve', help = "Run the daemon")
+    serve.add_argument('--stop-timeout', type = float, default = 10,
+                       help = "Seconds to wait for QEMU to quit before "
+                              "sending a signal")
+    start = sub.add_parser('start', help = "Start a VM, with the qrun "
+                                           "arguments given after '--'")
+    start.add_argument('--restart', action='store_true',
+                       help = "Restart the VM when QEMU exits")
+    for name, desc in [('stop', "Stop a VM"),
+                       ('stats', "Show the runtime statistics of a VM")]:
+        p = sub.add_parser(name, help = desc)
+        p.add_argument('vm', type = int,
+                       help = "Management index of the VM (-m)")
+    sub.add_parser('list', help = "List the supervised VMs")
+
+    # Everything after '--' is passed to qrun untouched
+    vmargv = []
+    if '--' in argv:
+        vmargv = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    dargs = parser.parse_args(argv)
+
+    path = dargs.socket or os.path.join(dargs.run_dir, 'qrund.sock')
+
+    if dargs.cmd == 'serve':
+        daemon = Daemon(dargs.run_dir, dargs.stop_timeout)
+        asyncio.run(daemon.serve(path))
+    elif dargs.cmd == 'start':
+        resp = request(path, {'cmd': 'start', 'argv': vmargv,
+                              'restart': dargs.restart})
+        print(json.dumps(resp['vm'], indent = 2))
+    elif dargs.cmd in ['stop', 'stats']:
+        resp = request(path, {'cmd': dargs.cmd, 'vm': dargs.vm})
+        print(json.dumps(resp.get('stats', resp.get('vm')), indent = 2))
+    elif dargs.cmd == 'list':
+        resp = request(path, {'cmd': 'list'})
+        for vm in resp['vms']:
+            print("%4d  %-10s  pid %-8s  ssh %-6d  restarts %d" %
+                  (vm['vm'], vm['status'], vm['pid'], vm['ssh_port'],
+                   vm['restarts']))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])